@@ -36,6 +36,10 @@ class BaseNeuron:
     block_callbacks: List[Callable] = []
     substrate_thread: Thread
 
+    # Neurons that fork start the block thread themselves once they have
+    # forked, so child processes never inherit a running thread
+    defer_block_thread = False
+
     def check_registered(self):
         if not self.subtensor.is_hotkey_registered(
             netuid=self.config.netuid,
@@ -122,4 +126,10 @@ class BaseNeuron:
             type_registry=TYPE_REGISTRY,
         )
         self.block_callbacks.append(self.maybe_sync_metagraph)
-        self.substrate_thread = run_block_callback_thread(self.substrate, self.run_callbacks)
+        if not self.defer_block_thread:
+            self.start_block_thread()
+
+    def start_block_thread(self):
+        self.substrate_thread = run_block_callback_thread(
+            self.substrate, self.run_callbacks
+        )
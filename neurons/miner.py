@@ -1,5 +1,12 @@
+import asyncio
+import multiprocessing as mp
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+import queue
+import socket
 import traceback
 import time
+from typing import Dict, List, Optional, Tuple
 from bittensor.core.axon import FastAPIThreadedServer
 from bittensor.core.extrinsics.serving import serve_extrinsic
 from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request
@@ -10,7 +17,22 @@ from starlette.background import BackgroundTask
 from starlette.responses import StreamingResponse
 
 from neurons.base import BaseNeuron, NeuronType
+from targon.admission import AdmissionController
 from targon.epistula import verify_signature
+from targon.metrics import (
+    ACTIVE_REQUESTS,
+    AUTH_LATENCY,
+    BYTES_PROXIED,
+    QUEUE_DEPTH,
+    QUEUE_WAIT,
+    REJECTIONS,
+    REQUESTS,
+    STREAMED_TPS,
+    UPSTREAM_TTFT,
+    start_metrics_server,
+)
+from targon.registry import ModelRegistry
+from targon.snapshot import SharedSnapshot
 from targon.utils import print_info
 import uvicorn
 import bittensor as bt
@@ -18,11 +40,42 @@ import bittensor as bt
 
 class Miner(BaseNeuron):
     neuron_type = NeuronType.Miner
-    fast_api: FastAPIThreadedServer
+    fast_api: Optional[FastAPIThreadedServer] = None
+    workers: List[BaseProcess] = []
+    supervisor: Optional[BaseProcess] = None
+
+    # Started once serving, after any worker processes are forked
+    defer_block_thread = True
+
+    # hotkey -> (uid, stake)
+    allowlist: Dict[str, Tuple[int, float]] = {}
+
+    # Set when running multiple worker processes. The parent publishes the
+    # allowlist and model registry here, workers pick up new versions lazily.
+    shared_state: Optional[SharedSnapshot] = None
+
+    # Set when running multiple worker processes. Workers send the models
+    # validators ask for back here, since the parent owns the registry.
+    demand: Optional[Queue] = None
 
     def shutdown(self):
         if self.fast_api:
             self.fast_api.stop()
+        if self.supervisor is not None:
+            # The supervisor stops its workers once terminated
+            self.supervisor.terminate()
+            self.supervisor.join(10)
+        self.stop_workers()
+
+    def stop_workers(self, timeout: float = 5):
+        for worker in self.workers:
+            worker.terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
 
     def log_on_block(self, block):
         print_info(
@@ -31,6 +84,49 @@ class Miner(BaseNeuron):
             block,
         )
 
+    def build_allowlist(self) -> Dict[str, Tuple[int, float]]:
+        return {
+            hotkey: (uid, self.metagraph.S[uid].item())
+            for uid, hotkey in enumerate(self.metagraph.hotkeys)
+        }
+
+    def sync_state_on_block(self, _):
+        self.allowlist = self.build_allowlist()
+        if self.shared_state is None:
+            return
+        if self.shared_state.publish(
+            {"allowlist": self.allowlist, "models": self.registry.models}
+        ):
+            bt.logging.debug("Published updated state to workers")
+
+    def load_shared_state(self):
+        "Called in worker processes to pick up the parent's latest state"
+        if self.shared_state is None or not self.shared_state.changed():
+            return
+        state = self.shared_state.read()
+        self.allowlist = {
+            hotkey: (uid, stake) for hotkey, (uid, stake) in state["allowlist"].items()
+        }
+        self.registry.models = state["models"]
+
+    def collect_demand(self):
+        "Model requests received by worker processes since the last block"
+        if self.demand is None:
+            return
+        while True:
+            try:
+                hotkey, models, received = self.demand.get_nowait()
+            except queue.Empty:
+                return
+            self.registry.record_request(hotkey, models, received)
+
+    def refresh_models_on_block(self, _):
+        self.collect_demand()
+        if not self.registry.refresh():
+            return
+        if len(missing := self.registry.missing()):
+            bt.logging.info(f"Validators are requesting unserved models: {missing}")
+
     def __init__(self, config=None):
         super().__init__(config)
         bt.logging.set_info()
@@ -41,69 +137,172 @@ class Miner(BaseNeuron):
 
         # Register log callback
         self.block_callbacks.append(self.log_on_block)
+        self.block_callbacks.append(self.refresh_models_on_block)
+        self.block_callbacks.append(self.sync_state_on_block)
 
         ## BITTENSOR INITIALIZATION
         bt.logging.info(
             "\N{grinning face with smiling eyes}", "Successfully Initialized!"
         )
-        bt.logging.info(self.config.model_endpoint)
-        self.client = httpx.AsyncClient(
-            base_url=self.config.model_endpoint,
-            headers={"Authorization": f"Bearer {self.config.api_key}"},
+        endpoints = [self.config.model_endpoint, *self.config.extra_model_endpoints]
+        bt.logging.info(endpoints)
+        self.clients = {
+            endpoint: httpx.AsyncClient(
+                base_url=endpoint,
+                headers={"Authorization": f"Bearer {self.config.api_key}"},
+            )
+            for endpoint in endpoints
+        }
+        self.client = self.clients[self.config.model_endpoint]
+        self.registry = ModelRegistry(
+            endpoints, self.config.api_key, ttl=self.config.models_ttl
+        )
+        self.admission = AdmissionController(
+            self.config.max_concurrent_requests,
+            self.config.max_validator_requests,
+            self.config.max_queued_requests,
+        )
+        QUEUE_DEPTH.set_function(lambda: self.admission.queued)
+        ACTIVE_REQUESTS.set_function(lambda: self.admission.active)
+        self.allowlist = self.build_allowlist()
+
+    def get_client(self, request: Request) -> httpx.AsyncClient:
+        # Validators send the model in a header so we dont have to parse the body
+        endpoint = self.registry.endpoint_for(request.headers.get("X-Targon-Model"))
+        if endpoint is None:
+            return self.client
+        return self.clients[endpoint]
+
+    async def proxy(self, request: Request, path: str):
+        optimistic = self.config.optimistic_forwarding
+        if optimistic:
+            # Cheap header and metagraph checks still happen before anything is
+            # sent upstream, only the signature check is overlapped.
+            now = round(time.time() * 1000)
+            self.verify_version(request)
+            self.verify_sender(request)
+
+        signed_by = request.headers.get("Epistula-Signed-By", "")
+        model = request.headers.get("X-Targon-Model", "")
+        if model not in self.registry.models:
+            model = "unknown"
+        ticket = await self.admission.acquire(
+            signed_by, getattr(request.state, "stake", 0)
+        )
+        QUEUE_WAIT.labels(signed_by).observe(ticket.queue_time)
+        try:
+            client = self.get_client(request)
+            body = await request.body()
+            req = client.build_request("POST", path, content=body)
+            start = time.time()
+            if not optimistic:
+                r = await client.send(req, stream=True)
+            else:
+                # Timed from here so queueing is not counted as auth latency
+                auth_start = time.perf_counter()
+                send = asyncio.create_task(client.send(req, stream=True))
+                try:
+                    await asyncio.to_thread(self.verify_body, request, body, now)  # type: ignore
+                except BaseException:
+                    await self.discard(send)
+                    raise
+                AUTH_LATENCY.labels(signed_by).observe(
+                    time.perf_counter() - auth_start
+                )
+                r = await send
+        except BaseException:
+            ticket.release()
+            raise
+        REQUESTS.labels(signed_by, model).inc()
+        upstream_time = time.time() - start
+        bt.logging.debug(
+            f"{signed_by[:8]} {path}: queued {ticket.queue_time * 1000:.0f}ms, upstream responded in {upstream_time * 1000:.0f}ms"
         )
 
+        async def close():
+            await r.aclose()
+            ticket.release()
+
+        async def stream():
+            first_byte = None
+            total_bytes = 0
+            events = 0
+            try:
+                async for chunk in r.aiter_raw():
+                    if first_byte is None:
+                        first_byte = time.time()
+                        UPSTREAM_TTFT.labels(signed_by, model).observe(
+                            first_byte - start
+                        )
+                    total_bytes += len(chunk)
+                    events += chunk.count(b"data:")
+                    yield chunk
+            finally:
+                await close()
+                BYTES_PROXIED.labels(signed_by, model).inc(total_bytes)
+                if first_byte is not None and (duration := time.time() - first_byte):
+                    STREAMED_TPS.labels(signed_by, model).observe(events / duration)
+
+        return StreamingResponse(
+            stream(),
+            background=BackgroundTask(close),
+            headers={
+                **r.headers,
+                "X-Targon-Queue-Time": str(round(ticket.queue_time * 1000)),
+            },
+        )
+
+    async def discard(self, send: "asyncio.Task[httpx.Response]"):
+        "Cancel an upstream request started before the caller was verified"
+        send.cancel()
+        try:
+            r = await send
+        except BaseException:
+            return
+        await r.aclose()
+
     async def create_chat_completion(self, request: Request):
         bt.logging.info(
             "\u2713",
             f"Getting Chat Completion request from {request.headers.get('Epistula-Signed-By', '')[:8]}!",
         )
-        req = self.client.build_request(
-            "POST", "/chat/completions", content=await request.body()
-        )
-        r = await self.client.send(req, stream=True)
-        return StreamingResponse(
-            r.aiter_raw(), background=BackgroundTask(r.aclose), headers=r.headers
-        )
+        return await self.proxy(request, "/chat/completions")
 
     async def create_completion(self, request: Request):
         bt.logging.info(
             "\u2713",
             f"Getting Completion request from {request.headers.get('Epistula-Signed-By', '')[:8]}!",
         )
-        req = self.client.build_request(
-            "POST", "/completions", content=await request.body()
-        )
-        r = await self.client.send(req, stream=True)
-        return StreamingResponse(
-            r.aiter_raw(), background=BackgroundTask(r.aclose), headers=r.headers
-        )
+        return await self.proxy(request, "/completions")
 
     async def receive_models(self, request: Request):
         models = await request.json()
+        signed_by = request.headers.get("Epistula-Signed-By", "")
         bt.logging.info(
             "\u2713",
-            f"Received model list from {request.headers.get('Epistula-Signed-By', '')[:8]}: {models}",
+            f"Received model list from {signed_by[:8]}: {models}",
         )
-
-        #
-        # Add extra logic here for how your miner should handle the model list.
-        #
-
+        if not isinstance(models, list):
+            return ""
+        if self.demand is not None:
+            self.demand.put((signed_by, models, time.time()))
+        else:
+            self.registry.record_request(signed_by, models)
         return ""
 
     async def list_models(self):
-        #
-        # Return models the miner is running
-        #
-
-        return []
+        # Served from memory, refreshed from the upstream endpoints on block
+        return self.registry.list()
 
     async def determine_epistula_version_and_verify(self, request: Request):
+        self.verify_version(request)
+        await self.verify_request(request)
+
+    def verify_version(self, request: Request):
         version = request.headers.get("Epistula-Version")
-        if version == "2":
-            await self.verify_request(request)
-            return
-        raise HTTPException(status_code=400, detail="Unknown Epistula version")
+        if version != "2":
+            REJECTIONS.labels(reason="bad_version").inc()
+            raise HTTPException(status_code=400, detail="Unknown Epistula version")
 
     async def verify_request(
         self,
@@ -112,39 +311,52 @@ class Miner(BaseNeuron):
         # We do this as early as possible so that now has a lesser chance
         # of causing a stale request
         now = round(time.time() * 1000)
+        auth_start = time.perf_counter()
+        self.verify_sender(request)
+        body = await request.body()
+        self.verify_body(request, body, now)
+        AUTH_LATENCY.labels(request.headers.get("Epistula-Signed-By")).observe(
+            time.perf_counter() - auth_start
+        )
 
-        # We need to check the signature of the body as bytes
-        # But use some specific fields from the body
+    def verify_sender(self, request: Request):
+        self.load_shared_state()
         signed_by = request.headers.get("Epistula-Signed-By")
         signed_for = request.headers.get("Epistula-Signed-For")
         if signed_for != self.wallet.hotkey.ss58_address:
+            REJECTIONS.labels(reason="wrong_recipient").inc()
             raise HTTPException(
                 status_code=400, detail="Bad Request, message is not intended for self"
             )
-        if signed_by not in self.metagraph.hotkeys:
+        if signed_by is None or (sender := self.allowlist.get(signed_by)) is None:
+            REJECTIONS.labels(reason="unknown_signer").inc()
             raise HTTPException(status_code=401, detail="Signer not in metagraph")
 
-        uid = self.metagraph.hotkeys.index(signed_by)
-        stake = self.metagraph.S[uid].item()
+        uid, stake = sender
         if not self.config.no_force_validator_permit and stake < 10000:
             bt.logging.warning(
                 f"Blacklisting request from {signed_by} [uid={uid}], not enough stake -- {stake}"
             )
+            REJECTIONS.labels(reason="low_stake").inc()
             raise HTTPException(status_code=401, detail="Stake below minimum: {stake}")
+        request.state.stake = stake
 
+    def verify_body(self, request: Request, body: bytes, now: int):
+        # We need to check the signature of the body as bytes
+        # But use some specific fields from the body
         # If anything is returned here, we can throw
-        body = await request.body()
         err = verify_signature(
             request.headers.get("Epistula-Request-Signature"),
             body,
             request.headers.get("Epistula-Timestamp"),
             request.headers.get("Epistula-Uuid"),
-            signed_for,
-            signed_by,
+            request.headers.get("Epistula-Signed-For"),
+            request.headers.get("Epistula-Signed-By"),
             now,
         )
         if err:
             bt.logging.error(err)
+            REJECTIONS.labels(reason="bad_signature").inc()
             raise HTTPException(status_code=400, detail=err)
 
     def run(self):
@@ -162,6 +374,7 @@ class Miner(BaseNeuron):
             except Exception:
                 bt.logging.error("Failed to get external IP")
 
+        self.registry.refresh(force=True)
         bt.logging.info(
             f"Serving miner endpoint {external_ip}:{self.config.axon.port} on network: {self.config.subtensor.chain_endpoint} with netuid: {self.config.netuid}"
         )
@@ -182,16 +395,23 @@ class Miner(BaseNeuron):
         # change the config in the axon
         app = FastAPI()
         router = APIRouter()
+
+        # Optimistic forwarding verifies inside the handler instead
+        inference_dependencies = []
+        if not self.config.optimistic_forwarding:
+            inference_dependencies = [
+                Depends(self.determine_epistula_version_and_verify)
+            ]
         router.add_api_route(
             "/v1/chat/completions",
             self.create_chat_completion,
-            dependencies=[Depends(self.determine_epistula_version_and_verify)],
+            dependencies=inference_dependencies,
             methods=["POST"],
         )
         router.add_api_route(
             "/v1/completions",
             self.create_completion,
-            dependencies=[Depends(self.determine_epistula_version_and_verify)],
+            dependencies=inference_dependencies,
             methods=["POST"],
         )
         router.add_api_route(
@@ -214,8 +434,26 @@ class Miner(BaseNeuron):
             log_level="info",
             loop="asyncio",
         )
-        self.fast_api = FastAPIThreadedServer(config=fast_config)
-        self.fast_api.start()
+        if self.config.workers > 1:
+            ctx = mp.get_context("fork")
+            self.shared_state = SharedSnapshot()
+            self.demand = ctx.Queue()
+            self.sync_state_on_block(None)
+            sock = fast_config.bind_socket()
+
+            # Forked before the block thread starts. Workers are forked and
+            # restarted from the supervisor, so they never fork from a process
+            # with threads running either.
+            self.supervisor = ctx.Process(
+                target=self.supervise_workers, args=(fast_config, sock)
+            )
+            self.supervisor.start()
+        else:
+            self.fast_api = FastAPIThreadedServer(config=fast_config)
+            self.fast_api.start()
+            if self.config.metrics_port:
+                start_metrics_server(self.config.metrics_port)
+        self.start_block_thread()
 
         bt.logging.info(f"Miner starting at block: {self.subtensor.block}")
 
@@ -223,11 +461,54 @@ class Miner(BaseNeuron):
         try:
             while not self.exit_context.isExiting:
                 time.sleep(1)
+                if self.supervisor is None or self.supervisor.is_alive():
+                    continue
+                if not self.exit_context.isExiting:
+                    bt.logging.error(
+                        f"Worker supervisor exited with {self.supervisor.exitcode}"
+                    )
+                break
         except Exception as e:
             bt.logging.error(str(e))
             bt.logging.error(traceback.format_exc())
         self.shutdown()
 
+    def supervise_workers(self, fast_config: uvicorn.Config, sock: socket.socket):
+        "Starts the workers and restarts any that exit, until told to stop"
+        self.workers = [
+            self.start_worker(fast_config, sock, i) for i in range(self.config.workers)
+        ]
+        while not self.exit_context.isExiting:
+            time.sleep(1)
+            for i, worker in enumerate(self.workers):
+                if worker.is_alive() or self.exit_context.isExiting:
+                    continue
+                bt.logging.error(
+                    f"Worker {worker.pid} exited with {worker.exitcode}, restarting"
+                )
+                self.workers[i] = self.start_worker(fast_config, sock, i)
+        # Not shutdown, the supervisor's own Process object was inherited
+        self.stop_workers()
+
+    def start_worker(self, fast_config: uvicorn.Config, sock: socket.socket, index: int):
+        # Forked so workers inherit the wallet, clients and shared state without
+        # re-initializing bittensor. Workers only serve requests, the block
+        # thread stays in the parent.
+        worker = mp.get_context("fork").Process(
+            target=self.run_worker, args=(fast_config, sock, index), daemon=True
+        )
+        worker.start()
+        bt.logging.info(f"Started worker {index}: {worker.pid}")
+        return worker
+
+    def run_worker(self, fast_config: uvicorn.Config, sock: socket.socket, index: int):
+        self.workers = []
+
+        # Metrics are per process, so each worker serves its own
+        if self.config.metrics_port:
+            start_metrics_server(self.config.metrics_port + index)
+        uvicorn.Server(config=fast_config).run(sockets=[sock])
+
 
 if __name__ == "__main__":
     try:
@@ -1,6 +1,8 @@
 import json
+import os
 import random
 import asyncio
+from concurrent.futures import Future
 import sys
 from threading import Thread
 from time import sleep
@@ -21,7 +23,17 @@ from targon.config import (
 from targon.dataset import download_dataset
 from targon.docker import load_docker, sync_output_checkers
 from targon.epistula import generate_header
-from targon.jugo import score_organics, send_organics_to_jugo, send_stats_to_jugo
+from targon.database import create_pool, score_organics_from_db
+from targon.jugo import (
+    ORGANICS_CONCURRENCY,
+    ORGANICS_TIMEOUT,
+    JugoUploader,
+    ScoreDeltas,
+    create_stats_body,
+    score_organics,
+    send_organics_to_jugo,
+)
+from targon.ledger import OrganicLedger
 from targon.math import get_weights
 from targon.metagraph import (
     create_set_weights,
@@ -29,13 +41,21 @@ from targon.metagraph import (
     resync_hotkeys,
     run_block_callback_thread,
 )
-from targon.request import check_tokens, generate_request, handle_inference
+from targon.request import (
+    VerificationSession,
+    check_tokens,
+    check_tokens_batch,
+    generate_request,
+    handle_inference,
+)
+from targon.runtime import AsyncRuntime
 from targon.updater import autoupdate
 from targon.utils import (
     fail_with_none,
     print_info,
 )
 from targon.types import Endpoints, InferenceStats
+from targon.verifiers import VerifierPool, parse_remote_verifiers
 import traceback
 import bittensor as bt
 
@@ -53,7 +73,7 @@ class Validator(BaseNeuron):
     neuron_type = NeuronType.Validator
     miner_tps: Dict[int, Dict[str, List[Optional[float]]]]
     miner_models: Dict[int, List[str]]
-    db: Optional[asyncpg.Connection]
+    db: Optional[asyncpg.Pool]
     verification_ports: Dict[str, Dict[str, Any]]
     models: List[str]
     lock_waiting = False
@@ -62,6 +82,12 @@ class Validator(BaseNeuron):
     organics = {}
     last_bucket_id = None
     heartbeat_thread: Thread
+    jugo_uploader: JugoUploader
+    organics_ledger: OrganicLedger
+    runtime: AsyncRuntime
+    organics_future: Optional[Future] = None
+    verifier_sync: Optional[Thread] = None
+    score_deltas: ScoreDeltas
     step = 0
     dataset = None
 
@@ -70,6 +96,10 @@ class Validator(BaseNeuron):
         ## Typesafety
         self.set_weights = create_set_weights(spec_version, self.config.netuid)
 
+        ## ASYNC RUNTIME
+        # All async work, from the main loop or block callbacks, runs here
+        self.runtime = AsyncRuntime()
+
         ## CHECK IF REGG'D
         if not self.metagraph.validator_permit[self.uid] and not IS_TESTNET:
             bt.logging.error("Validator does not have vpermit")
@@ -82,9 +112,13 @@ class Validator(BaseNeuron):
         assert self.config.cache_file
         assert self.config.vpermit_tao_limit
         assert self.config.database
+        assert self.config.organics
         assert self.config.subtensor
+        assert self.config.neuron
+        assert self.config.verifiers
         ## LOAD DOCKER
         self.client = load_docker()
+        self.remote_verifiers = parse_remote_verifiers(self.config.verifiers.remote)
 
         ## SET MISC PARAMS
         self.next_forward_block = None
@@ -104,13 +138,32 @@ class Validator(BaseNeuron):
         ## CONNECT TO ORGANICS DB
         try:
             self.db = None
-            if self.config.database.url:
-                self.db = self.loop.run_until_complete(
-                    asyncpg.connect(self.config.database.url)
-                )
+            if self.config.organics.source == "database":
+                assert self.config.database.url, "--database.url is required"
+                self.db = self.runtime.run(create_pool(self.config.database.url))
         except Exception as e:
             bt.logging.error(f"Failed to initialize organics database: {e}")
 
+        ## RESTORE ORGANICS
+        self.organics_ledger = OrganicLedger(
+            os.path.join(self.config.neuron.full_path, "organics_ledger.json")
+        )
+        latest_bucket = self.organics_ledger.latest()
+        if latest_bucket is not None:
+            self.organics = self.organics_ledger.scores(latest_bucket)
+            if self.organics_ledger.is_complete(latest_bucket):
+                self.last_bucket_id = latest_bucket
+            bt.logging.info(f"Restored organics for bucket {latest_bucket}")
+
+        ## START JUGO UPLOADS
+        self.score_deltas = ScoreDeltas()
+        self.jugo_uploader = JugoUploader(
+            self.wallet,
+            os.path.join(self.config.neuron.full_path, "jugo_spool"),
+            score_deltas=self.score_deltas,
+        )
+        self.jugo_uploader.start(self.runtime)
+
         ## REGISTER BLOCK CALLBACKS
         self.block_callbacks.extend(
             [
@@ -202,20 +255,64 @@ class Validator(BaseNeuron):
             return
         if block % self.config.epoch_length:
             return
-        self.lock_halt = True
-        while not self.lock_waiting:
-            sleep(1)
         self.models = self.get_models()
-        self.verification_ports = sync_output_checkers(self.client, self.models)
-        self.lock_halt = False
+        self.start_verifier_sync()
+
+    def start_verifier_sync(self):
+        """
+        Syncs verifiers on a thread of its own, since draining and starting
+        containers can take up to an hour. Verifiers that are kept serve
+        throughout and new ones are added to verification_ports as they come
+        up, on the runtime loop, so the main loop keeps going.
+        """
+        if self.verifier_sync is not None and self.verifier_sync.is_alive():
+            bt.logging.info("Still syncing verifiers from last epoch")
+            return
+        self.verifier_sync = Thread(
+            name="verifier-sync",
+            target=fail_with_none("Failed syncing verifiers")(sync_output_checkers),
+            args=(self.client, list(self.models)),
+            kwargs={
+                "replicas": self.config.verifiers.replicas,
+                "remote": self.remote_verifiers,
+                "verification_ports": self.verification_ports,
+                "apply": self.runtime.call,
+            },
+            daemon=True,
+        )
+        self.verifier_sync.start()
 
     def score_organics_on_block(self, block):
         if not self.is_runing:
             return
         if block % 20:
             return
-        res = asyncio.run(
-            score_organics(self.last_bucket_id, self.verification_ports, self.wallet)
+        if self.organics_future is not None and not self.organics_future.done():
+            bt.logging.info("Still scoring previous organics bucket")
+            return
+        self.organics_future = self.runtime.submit(self.score_organics())
+
+    async def score_organics(self):
+        if self.config.organics.source == "database":
+            if self.db is None:
+                return
+            organics = await score_organics_from_db(
+                self.db,
+                self.verification_ports,
+                self.runtime.http,
+                ORGANICS_CONCURRENCY,
+                ORGANICS_TIMEOUT,
+            )
+            if organics is not None:
+                self.organics = organics
+            return
+        res = await score_organics(
+            self.last_bucket_id,
+            self.verification_ports,
+            self.wallet,
+            client=self.runtime.http,
+            session=self.runtime.session,
+            ledger=self.organics_ledger,
         )
         if res == None:
             return
@@ -224,7 +321,9 @@ class Validator(BaseNeuron):
         if organics == None or organic_stats == None:
             return
         self.organics = organics
-        asyncio.run(send_organics_to_jugo(self.wallet, organic_stats))
+        await send_organics_to_jugo(
+            self.wallet, organic_stats, session=self.runtime.session
+        )
 
     def set_weights_on_interval(self, block):
         if block % self.config.epoch_length:
@@ -277,7 +376,8 @@ class Validator(BaseNeuron):
 
         # Ensure everything is setup
         self.models = self.get_models()
-        self.verification_ports = sync_output_checkers(self.client, self.models)
+        self.verification_ports = {}
+        self.start_verifier_sync()
         resync_hotkeys(self.metagraph, self.miner_tps)
         self.send_models_to_miners_on_interval(0)
 
@@ -305,20 +405,29 @@ class Validator(BaseNeuron):
                     sleep(1)
                 self.lock_waiting = False
 
+            # Verifiers are synced on another thread, work off a snapshot
+            verification_ports = dict(self.verification_ports)
+            if not len(verification_ports):
+                assert self.verifier_sync
+                if not self.verifier_sync.is_alive():
+                    bt.logging.error("No verification ports")
+                    break
+                bt.logging.info("Waiting for verifiers to start")
+                sleep(5)
+                continue
+
             # Random model, but every three is a model we are verifying for sure
             model_name = random.choice(self.models)
             if self.step % 3 == 0:
-                model_name = random.choice(list(self.verification_ports.keys()))
+                model_name = random.choice(list(verification_ports.keys()))
 
-            endpoint_model = list(self.verification_ports.keys())[0]
-            if self.verification_ports.get(model_name) != None:
-                endpoint = random.choice(
-                    self.verification_ports[model_name]["endpoints"]
-                )
+            endpoint_model = list(verification_ports.keys())[0]
+            if verification_ports.get(model_name) != None:
+                endpoint = random.choice(verification_ports[model_name]["endpoints"])
                 generator_model_name = model_name
             else:
                 endpoint = random.choice(
-                    self.verification_ports[endpoint_model]["endpoints"]
+                    verification_ports[endpoint_model]["endpoints"]
                 )
                 generator_model_name = endpoint_model
             uids = get_miner_uids(
@@ -344,15 +453,15 @@ class Validator(BaseNeuron):
                 bt.logging.info("No miners for this model")
                 continue
 
-            res = self.loop.run_until_complete(
+            res = self.runtime.run(
                 self.query_miners(
                     miner_uids, model_name, endpoint, generator_model_name
                 )
             )
             self.save_scores()
             if res is not None:
-                self.loop.run_until_complete(
-                    send_stats_to_jugo(
+                self.jugo_uploader.submit(
+                    create_stats_body(
                         self.metagraph,
                         self.subtensor,
                         self.wallet,
@@ -366,21 +475,76 @@ class Validator(BaseNeuron):
         # Exiting
         self.shutdown()
 
-    async def verify_response(self, uid, request, endpoint, stat: InferenceStats):
+    async def verify_response(
+        self,
+        uid,
+        request,
+        endpoint,
+        stat: InferenceStats,
+        session: Optional[VerificationSession] = None,
+    ):
         if stat.error or stat.cause:
+            if session is not None:
+                await session.close()
             return uid, stat
+        if session is not None:
+            verified = await session.finish()
+            return self.apply_verdict(uid, stat, verified)
         # We do this out of the handle_inference loop to not block other requests
-        verification_port = self.verification_ports.get(
-            request["model"], {"port": None}
-        ).get("port")
-        if verification_port is None:
-            bt.logging.error(
-                "Send request to a miner without verification port for model"
-            )
+        verifier = self.verification_ports.get(request["model"], {}).get("pool")
+        if verifier is None:
+            bt.logging.error("Send request to a miner without verifier for model")
             return uid, None
         verified = await check_tokens(
-            request, stat.tokens, uid, endpoint=endpoint, port=verification_port
+            request,
+            stat.tokens,
+            uid,
+            endpoint=endpoint,
+            verifier=verifier,
+            client=self.runtime.http,
+        )
+        return self.apply_verdict(uid, stat, verified)
+
+    async def verify_responses(
+        self, responses: List[Tuple[int, InferenceStats]], request, endpoint
+    ) -> List[Tuple[int, Optional[InferenceStats]]]:
+        "Verifies every miner's response to one request in a single batch"
+        to_verify = [
+            (uid, stat) for uid, stat in responses if not (stat.error or stat.cause)
+        ]
+        verifier = self.verification_ports.get(request["model"], {}).get("pool")
+        if verifier is None or not len(to_verify):
+            return await asyncio.gather(
+                *[
+                    self.verify_response(uid, request, endpoint, stat)
+                    for uid, stat in responses
+                ]
+            )
+        verdicts = await check_tokens_batch(
+            request,
+            [stat.tokens for _, stat in to_verify],
+            [uid for uid, _ in to_verify],
+            endpoint,
+            verifier,
+            client=self.runtime.http,
         )
+        if verdicts is None:
+            # Verifiers without batch support
+            return await asyncio.gather(
+                *[
+                    self.verify_response(uid, request, endpoint, stat)
+                    for uid, stat in responses
+                ]
+            )
+        by_uid = {uid: verdict for (uid, _), verdict in zip(to_verify, verdicts)}
+        return [
+            (uid, stat)
+            if uid not in by_uid
+            else self.apply_verdict(uid, stat, by_uid[uid])
+            for uid, stat in responses
+        ]
+
+    def apply_verdict(self, uid, stat: InferenceStats, verified: Optional[Dict]):
         if verified is None:
             return uid, None
         stat.verified = (
@@ -400,16 +564,20 @@ class Validator(BaseNeuron):
     ):
         assert self.config.database
 
-        verification_port: Optional[int] = self.verification_ports.get(
-            generator_model_name, {"port": None}
-        ).get("port")
-        if verification_port is None:
+        verifier: Optional[VerifierPool] = self.verification_ports.get(
+            generator_model_name, {}
+        ).get("pool")
+        if verifier is None:
             bt.logging.error(
                 f"No generator / verifier found for {generator_model_name}"
             )
             return None
-        request = generate_request(
-            self.dataset, generator_model_name, endpoint, verification_port
+        request = await generate_request(
+            self.dataset,
+            generator_model_name,
+            endpoint,
+            verifier,
+            client=self.runtime.http,
         )
         if not request:
             bt.logging.info("No request was generated")
@@ -417,6 +585,15 @@ class Validator(BaseNeuron):
 
         bt.logging.info(f"{model_name} - {endpoint}: {request}")
 
+        # Verify while miners stream, when we are running the model they serve
+        sessions: Dict[int, VerificationSession] = {}
+        if self.config.streaming_verification and generator_model_name == model_name:
+            for uid in miner_uids:
+                sessions[uid] = VerificationSession(
+                    request, uid, endpoint, verifier, self.runtime.http
+                )
+                sessions[uid].start()
+
         # We do these in separate groups for better response timings
         tasks = []
         try:
@@ -424,7 +601,12 @@ class Validator(BaseNeuron):
                 tasks.append(
                     asyncio.create_task(
                         handle_inference(
-                            self.metagraph, self.wallet, request, uid, endpoint
+                            self.metagraph,
+                            self.wallet,
+                            request,
+                            uid,
+                            endpoint,
+                            session=sessions.get(uid),
                         )
                     )
                 )
@@ -434,19 +616,27 @@ class Validator(BaseNeuron):
             if generator_model_name != model_name:
                 return None
 
-            tasks = []
-            for uid, stat in responses:
-                tasks.append(
-                    asyncio.create_task(
-                        self.verify_response(uid, request, endpoint, stat)
+            stats: List[Tuple[int, Optional[InferenceStats]]]
+            if len(sessions):
+                tasks = []
+                for uid, stat in responses:
+                    tasks.append(
+                        asyncio.create_task(
+                            self.verify_response(
+                                uid, request, endpoint, stat, session=sessions[uid]
+                            )
+                        )
                     )
-                )
-            stats: List[Tuple[int, Optional[InferenceStats]]] = await asyncio.gather(
-                *tasks
-            )
+                stats = await asyncio.gather(*tasks)
+            else:
+                stats = await self.verify_responses(responses, request, endpoint)
         except Exception:
             bt.logging.error(f"Failed sending requests: {traceback.format_exc()}")
             stats = []
+        finally:
+            # Sessions left open would count as outstanding on their verifier
+            # until the verifier expires them
+            await asyncio.gather(*[session.close() for session in sessions.values()])
         processed_stats = []
         for uid, stat in stats:
             if not stat:
@@ -491,9 +681,11 @@ class Validator(BaseNeuron):
             bt.logging.error(f"Failed writing to cache file: {e}")
 
     def shutdown(self):
+        self.jugo_uploader.stop()
         if self.db:
             bt.logging.info("Closing organics db connection")
-            self.loop.run_until_complete(self.db.close())
+            self.runtime.run(self.db.close())
+        self.runtime.stop()
 
     def get_models(self) -> List[str]:
         """
@@ -10,7 +10,7 @@ endpoint = Endpoints.CHAT
 if __name__ == "__main__":
     validator = Validator(run_init=False)
     validator.dataset = download_dataset(True)
-    res = validator.loop.run_until_complete(
+    res = validator.runtime.run(
         validator.query_miners(miners, model_name, endpoint)
     )
     with open("results.json", "w") as file:
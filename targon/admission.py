@@ -0,0 +1,109 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, List, Tuple
+
+from fastapi import HTTPException
+
+from targon.metrics import REJECTIONS
+
+
+class Ticket:
+    """
+    An admitted request. Release exactly once when the upstream stream closes;
+    extra calls are ignored so every exit path can safely release.
+    """
+
+    def __init__(self, controller: "AdmissionController", hotkey: str, queue_time):
+        self.controller = controller
+        self.hotkey = hotkey
+        self.queue_time = queue_time
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.controller.release(self.hotkey)
+
+
+class AdmissionController:
+    """
+    Bounds how many requests the miner proxies upstream at once.
+
+    Requests past `max_concurrent` wait in a bounded queue, highest validator
+    stake first. Requests that would overflow the queue or push a validator past
+    `max_per_validator` are rejected immediately with a 429 instead of slowing
+    down every stream in flight. A limit of 0 disables that limit.
+
+    Not thread safe, must only be used from the server's event loop.
+    """
+
+    def __init__(self, max_concurrent: int, max_per_validator: int, max_queue: int):
+        self.max_concurrent = max_concurrent
+        self.max_per_validator = max_per_validator
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+
+        # Active and queued requests per validator hotkey
+        self.per_validator: Dict[str, int] = {}
+        self.waiting: List[Tuple[float, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+
+    def has_capacity(self):
+        return not self.max_concurrent or self.active < self.max_concurrent
+
+    async def acquire(self, hotkey: str, stake: float) -> Ticket:
+        start = time.monotonic()
+        if (
+            self.max_per_validator
+            and self.per_validator.get(hotkey, 0) >= self.max_per_validator
+        ):
+            REJECTIONS.labels(reason="validator_limit").inc()
+            raise HTTPException(
+                status_code=429, detail="Too many concurrent requests from validator"
+            )
+        if self.has_capacity() and not self.queued:
+            self.active += 1
+            self.per_validator[hotkey] = self.per_validator.get(hotkey, 0) + 1
+            return Ticket(self, hotkey, 0)
+        if self.queued >= self.max_queue:
+            REJECTIONS.labels(reason="queue_full").inc()
+            raise HTTPException(status_code=429, detail="Miner queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (-stake, next(self.counter), future))
+        self.queued += 1
+        self.per_validator[hotkey] = self.per_validator.get(hotkey, 0) + 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Caller went away. If we were already handed a slot, give it back,
+            # otherwise just drop out of the queue.
+            if future.cancelled():
+                self.queued -= 1
+                self._forget(hotkey)
+            else:
+                self.release(hotkey)
+            raise
+        return Ticket(self, hotkey, time.monotonic() - start)
+
+    def release(self, hotkey: str):
+        self.active -= 1
+        self._forget(hotkey)
+        while self.waiting and self.has_capacity():
+            _, _, future = heapq.heappop(self.waiting)
+            if future.cancelled():
+                continue
+            self.active += 1
+            self.queued -= 1
+            future.set_result(None)
+
+    def _forget(self, hotkey: str):
+        count = self.per_validator.get(hotkey, 0) - 1
+        if count <= 0:
+            self.per_validator.pop(hotkey, None)
+            return
+        self.per_validator[hotkey] = count
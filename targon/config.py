@@ -116,6 +116,63 @@ def add_miner_args(parser):
         help="API key for openai compatable api",
         default="12345",
     )
+    parser.add_argument(
+        "--extra-model-endpoints",
+        dest="extra_model_endpoints",
+        type=str,
+        nargs="*",
+        help="Additional OpenAI Compatible endpoints to serve models from. Requests are routed by model.",
+        default=[],
+    )
+    parser.add_argument(
+        "--models-ttl",
+        dest="models_ttl",
+        type=float,
+        help="How often to re-poll upstream endpoints for the models they serve, in seconds.",
+        default=60,
+    )
+    parser.add_argument(
+        "--max-concurrent-requests",
+        dest="max_concurrent_requests",
+        type=int,
+        help="Maximum requests proxied upstream at once. Extra requests are queued by validator stake. 0 for no limit.",
+        default=128,
+    )
+    parser.add_argument(
+        "--max-validator-requests",
+        dest="max_validator_requests",
+        type=int,
+        help="Maximum in flight or queued requests from a single validator. 0 for no limit.",
+        default=32,
+    )
+    parser.add_argument(
+        "--max-queued-requests",
+        dest="max_queued_requests",
+        type=int,
+        help="Maximum requests waiting for an upstream slot before responding with 429.",
+        default=256,
+    )
+    parser.add_argument(
+        "--optimistic-forwarding",
+        dest="optimistic_forwarding",
+        action="store_true",
+        help="Start upstream requests while the request signature is still being verified. Nothing is returned until it passes.",
+        default=False,
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help="Number of server processes accepting requests on the axon port.",
+        default=1,
+    )
+    parser.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        type=int,
+        help="Serve prometheus metrics on 127.0.0.1 at this port. With multiple workers, worker N uses this port + N.",
+        default=None,
+    )
 
 
 def add_validator_args(parser):
@@ -152,6 +209,36 @@ def add_validator_args(parser):
         help="Database URL to score organic queries",
         default=None,
     )
+    parser.add_argument(
+        "--organics.source",
+        dest="organics.source",
+        type=str,
+        help="Where to read organic queries from. `database` reads them from --database.url",
+        choices=["jugo", "database"],
+        default="jugo",
+    )
+    parser.add_argument(
+        "--verifiers.replicas",
+        dest="verifiers.replicas",
+        type=int,
+        help="Local verifier containers to start per model, GPU space permitting",
+        default=1,
+    )
+    parser.add_argument(
+        "--verifiers.remote",
+        dest="verifiers.remote",
+        type=str,
+        nargs="*",
+        help="Verifiers on other hosts, as MODEL=URL. Repeat for more",
+        default=[],
+    )
+    parser.add_argument(
+        "--streaming-verification",
+        dest="streaming_verification",
+        action="store_true",
+        help="Verify miner outputs while they stream, cutting failed streams short",
+        default=False,
+    )
 
     parser.add_argument(
         "--models.mode",
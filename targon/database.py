@@ -0,0 +1,282 @@
+import asyncio
+import json
+import traceback
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncpg
+import bittensor as bt
+import httpx
+
+from targon.jugo import compact_organic, score_organic
+from targon.types import OrganicStats
+
+# Organic records are written to organic_requests by the validator's own
+# gateway. Each one gets at most one row in organic_verdicts once verified,
+# with a null score if it failed verification or could not be scored
+# (cause UNSCORABLE); records without a verdict are picked up on the next
+# pass.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS organic_requests (
+    id BIGSERIAL PRIMARY KEY,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    uid INTEGER NOT NULL,
+    hotkey TEXT NOT NULL,
+    coldkey TEXT NOT NULL,
+    model TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    success BOOLEAN NOT NULL,
+    request JSONB NOT NULL,
+    response JSONB,
+    response_tokens INTEGER,
+    time_to_first_token INTEGER,
+    total_time INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS organic_verdicts (
+    request_id BIGINT PRIMARY KEY REFERENCES organic_requests (id),
+    scored_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    uid INTEGER NOT NULL,
+    score DOUBLE PRECISION,
+    verified BOOLEAN,
+    error TEXT,
+    cause TEXT,
+    tps DOUBLE PRECISION,
+    time_to_first_token DOUBLE PRECISION,
+    time_for_all_tokens DOUBLE PRECISION,
+    total_time DOUBLE PRECISION,
+    total_tokens INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS organic_verdicts_scored_at
+    ON organic_verdicts (scored_at);
+
+-- Tables created before failed verdicts were recorded
+ALTER TABLE organic_verdicts ALTER COLUMN score DROP NOT NULL;
+"""
+
+UNSCORED_QUERY = """
+SELECT r.*
+FROM organic_requests r
+WHERE r.model = ANY($1::text[])
+    AND NOT EXISTS (SELECT 1 FROM organic_verdicts v WHERE v.request_id = r.id)
+ORDER BY r.id
+LIMIT $2
+"""
+
+# Unscorable records say nothing about the miner, so they are left out
+RECENT_SCORES_QUERY = """
+SELECT uid, score
+FROM organic_verdicts
+WHERE scored_at > now() - make_interval(secs => $1)
+    AND cause IS DISTINCT FROM 'UNSCORABLE'
+"""
+
+VERDICT_COLUMNS = [
+    "request_id",
+    "uid",
+    "score",
+    "verified",
+    "error",
+    "cause",
+    "tps",
+    "time_to_first_token",
+    "time_for_all_tokens",
+    "total_time",
+    "total_tokens",
+]
+
+# Records read per pass, rows fetched per cursor round trip, and verdicts
+# written per COPY
+ORGANICS_LIMIT = 5000
+ORGANICS_PREFETCH = 100
+VERDICT_BATCH = 100
+# Organic scores used for weights cover verdicts from this many seconds back
+ORGANICS_WINDOW = 3600
+# Cause of verdicts for records that can't be scored, kept so they aren't
+# verified again on every pass
+UNSCORABLE = "UNSCORABLE"
+
+
+async def init_connection(conn: asyncpg.Connection):
+    for jsonb in ("json", "jsonb"):
+        await conn.set_type_codec(
+            jsonb, encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
+        )
+
+
+async def create_pool(url: str, max_size: int = 4) -> asyncpg.Pool:
+    "Connects to the organics database, creating the tables if needed"
+    pool = await asyncpg.create_pool(
+        url, min_size=1, max_size=max_size, init=init_connection
+    )
+    assert pool
+    async with pool.acquire() as conn:
+        await conn.execute(SCHEMA)
+    return pool
+
+
+def db_record(row: asyncpg.Record) -> Dict[str, Any]:
+    "Same shape as the records jugo serves"
+    record = dict(row)
+    record["response"] = record.get("response") or []
+    return record
+
+
+def verdict_row(
+    request_id: int,
+    uid: int,
+    score: Optional[float],
+    stats: Optional[OrganicStats],
+    unscorable: Optional[str] = None,
+) -> Tuple:
+    "`unscorable` is why a record without stats could not be scored"
+    if stats is None:
+        row = (request_id, uid, score) + (None,) * (len(VERDICT_COLUMNS) - 3)
+        if unscorable is None:
+            return row
+        return row[:4] + (unscorable, UNSCORABLE) + row[6:]
+    return (
+        request_id,
+        uid,
+        score,
+        stats.verified,
+        stats.error,
+        stats.cause,
+        stats.tps,
+        stats.time_to_first_token,
+        stats.time_for_all_tokens,
+        stats.total_time,
+        stats.total_tokens,
+    )
+
+
+async def read_unscored(
+    pool: asyncpg.Pool,
+    models: List[str],
+    queue: asyncio.Queue,
+    limit: int,
+    prefetch: int,
+) -> int:
+    """
+    Puts unscored records on `queue` as they are read. The cursor only
+    fetches `prefetch` rows at a time, and the queue is bounded, so reading
+    stalls while verification catches up.
+    """
+    count = 0
+    async with pool.acquire() as conn:
+        async with conn.transaction(readonly=True):
+            async for row in conn.cursor(
+                UNSCORED_QUERY, models, limit, prefetch=prefetch
+            ):
+                record = db_record(row)
+                await queue.put((record["model"], record, compact_organic(record)))
+                count += 1
+    return count
+
+
+async def write_verdicts(pool: asyncpg.Pool, rows: List[Tuple]):
+    async with pool.acquire() as conn:
+        await conn.copy_records_to_table(
+            "organic_verdicts", records=rows, columns=VERDICT_COLUMNS
+        )
+
+
+async def recent_scores(
+    pool: asyncpg.Pool, window: float = ORGANICS_WINDOW
+) -> Dict[int, List[Optional[float]]]:
+    """
+    Organic scores per uid, in the same shape score_organics returns. Failed
+    verdicts are None, which lowers the miner's organic score.
+    """
+    scores: Dict[int, List[Optional[float]]] = {}
+    async with pool.acquire() as conn:
+        for row in await conn.fetch(RECENT_SCORES_QUERY, float(window)):
+            scores.setdefault(row["uid"], []).append(row["score"])
+    return scores
+
+
+async def score_organics_from_db(
+    pool: asyncpg.Pool,
+    ports: Dict[str, Dict[str, Any]],
+    client: httpx.AsyncClient,
+    concurrency: int,
+    timeout: float,
+    limit: int = ORGANICS_LIMIT,
+    prefetch: int = ORGANICS_PREFETCH,
+    batch_size: int = VERDICT_BATCH,
+) -> Optional[Dict[int, List[Optional[float]]]]:
+    """
+    Verifies organic records that have no verdict yet, writing verdicts back
+    in batches. Returns the organic scores over the recent window.
+    """
+    try:
+        semaphores = {model: asyncio.Semaphore(concurrency) for model in ports}
+        workers = concurrency * max(len(ports), 1)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=workers)
+        pending: List[Tuple] = []
+
+        async def flush():
+            rows = pending[:]
+            pending.clear()
+            if len(rows):
+                await write_verdicts(pool, rows)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                # A bad record must not stop the worker, or reading blocks on
+                # the full queue forever with the transaction held open
+                try:
+                    await score_record(*item)
+                except Exception as e:
+                    bt.logging.error(f"Failed scoring organic: {e}")
+                    bt.logging.error(traceback.format_exc())
+
+        async def score_record(model, record, tokens):
+            unscorable = None
+            try:
+                score, organic_stat = await score_organic(
+                    model,
+                    record,
+                    tokens,
+                    ports,
+                    semaphores[model],
+                    timeout,
+                    client,
+                )
+            except Exception as e:
+                # Verifier and transport errors come back as None, so this
+                # is the record itself
+                bt.logging.error(f"Failed scoring organic {record['id']}: {e}")
+                score, organic_stat, unscorable = None, None, str(e)
+            # Timeouts and verifier errors have neither and are retried on the
+            # next pass. Failed verifications are recorded with no score.
+            if score is None and organic_stat is None and unscorable is None:
+                return
+            pending.append(
+                verdict_row(
+                    record["id"], record["uid"], score, organic_stat, unscorable
+                )
+            )
+            if len(pending) >= batch_size:
+                await flush()
+
+        tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+        try:
+            count = await read_unscored(
+                pool, list(ports.keys()), queue, limit, prefetch
+            )
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        await flush()
+        bt.logging.info(f"Scored {count} organics from database")
+        return await recent_scores(pool)
+    except Exception as e:
+        bt.logging.error(f"Failed scoring organics from database: {e}")
+        return None
@@ -1,6 +1,6 @@
-from time import sleep
+import time
 import random
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import re
 import math
 import docker
@@ -8,12 +8,13 @@ import bittensor as bt
 import subprocess
 from accelerate.commands import estimate
 
+from docker.errors import ImageNotFound
 from docker.models.containers import Container
+from docker.models.images import Image
 from docker.types import DeviceRequest
-import requests
 
 from targon.config import IMAGE_TAG
-from targon.types import Endpoints
+from targon.verifiers import Verifier, VerifierPool, supported_endpoints
 
 
 def get_gpu_with_space(gpus: List[Tuple[int, int, int]], required: int):
@@ -63,6 +64,10 @@ def estimate_max_size(model_name):
 
 
 MANIFOLD_VERIFIER = "manifoldlabs/sn4-verifier"
+# Longest a verifier container may take to download and load its model
+VERIFIER_STARTUP_TIMEOUT = 60 * 60
+# Longest a replaced verifier may take to finish what it was given
+VERIFIER_DRAIN_TIMEOUT = 10 * 60
 
 
 def load_docker():
@@ -90,124 +95,376 @@ def get_free_gpus() -> List[Tuple[int, int, int]]:
     return gpus
 
 
-def remove_containers(client):
+def verifier_name(model: str, replica: int) -> str:
+    name = re.sub(r"[\W_]", "-", model).lower()
+    if replica:
+        name += f"-{replica}"
+    return name
+
+
+def pull_if_changed(client: docker.DockerClient, image_name: str) -> Optional[Image]:
+    "Pulls the image only when the registry has a different digest than ours"
+    try:
+        local: Optional[Image] = client.images.get(image_name)  # type: ignore
+    except ImageNotFound:
+        local = None
+    try:
+        digest = client.images.get_registry_data(image_name).id
+        if local is not None and any(
+            repo_digest.endswith(f"@{digest}")
+            for repo_digest in local.attrs.get("RepoDigests", [])
+        ):
+            bt.logging.info(f"{image_name} is up to date")
+            return local
+        bt.logging.info(f"Pulling {image_name}")
+        return client.images.pull(image_name)  # type: ignore
+    except Exception as e:
+        bt.logging.error(str(e))
+    return local
+
+
+def reconcile_containers(
+    client: docker.DockerClient, desired: Dict[str, str], image_id: Optional[str]
+) -> Tuple[Dict[str, Container], List[Container]]:
+    """
+    Sorts verifier containers into those to keep, by name, and healthy ones
+    that aren't wanted anymore or are on an old image, which are left running
+    to be drained. The rest are removed. `desired` maps container names to the
+    model they should serve.
+    """
+    kept: Dict[str, Container] = {}
+    retiring: List[Container] = []
     containers: List[Container] = client.containers.list(  # type: ignore
-        filters={"label": "model"}
+        all=True, filters={"label": "model"}
     )
     for container in containers:
         model = container.labels.get("model")
+        healthy = container.status == "running" and container.health == "healthy"
+        current = desired.get(container.name) == model and (
+            image_id is None or container.attrs.get("Image") == image_id
+        )
+        if healthy and current:
+            kept[container.name] = container
+            continue
+        if healthy:
+            retiring.append(container)
+            continue
         bt.logging.info(f"Removing {container.name}: {model}")
         container.remove(force=True)
+    return kept, retiring
+
+
+def drain_containers(
+    retiring: List[Tuple[Container, Optional[Verifier]]],
+    timeout: float = VERIFIER_DRAIN_TIMEOUT,
+):
+    """
+    Removes containers once their verifier, already out of its pool, has no
+    requests in flight, or after `timeout`.
+    """
+    deadline = time.monotonic() + timeout
+    for container, verifier in retiring:
+        while (
+            verifier is not None
+            and verifier.outstanding
+            and time.monotonic() < deadline
+        ):
+            time.sleep(1)
+        if verifier is not None and verifier.outstanding:
+            bt.logging.error(
+                f"{container.name} still has {verifier.outstanding} requests, removing"
+            )
+        bt.logging.info(f"Removing {container.name}: {container.labels.get('model')}")
+        try:
+            container.remove(force=True)
+        except Exception as e:
+            bt.logging.error(f"Failed removing {container.name}: {e}")
+
+
+def named_containers(client, name: str, all=False) -> List[Container]:
+    "The name filter matches substrings, so replicas would match each other"
+    containers: List[Container] = client.containers.list(filters={"name": name}, all=all)  # type: ignore
+    return [container for container in containers if container.name == name]
+
+
+def place_verifiers(
+    wanted: List[Tuple[str, str]], gpus: List[Tuple[int, int, int]]
+) -> List[Tuple[str, str, List[Tuple[int, int, int]]]]:
+    """
+    Picks GPUs for every (container name, model) up front, so they can all be
+    started at once. Each container gets GPUs of its own.
+    """
+    free = list(gpus)
+    placed = []
+    sizes: Dict[str, Optional[int]] = {}
+    skipped = set()
+    for container_name, model in wanted:
+        if model in skipped:
+            continue
+        if model not in sizes:
+            sizes[model] = estimate_max_size(model)
+        required_vram = sizes[model]
+        if required_vram is None:
+            bt.logging.error(f"Failed to find model {model}")
+            skipped.add(model)
+            continue
+        chosen = get_gpu_with_space(free, required_vram)
+        if chosen is None:
+            bt.logging.info(f"Not enough space to run {container_name}")
+            # Later replicas won't fit either
+            skipped.add(model)
+            continue
+        taken = [gpu[0] for gpu in chosen]
+        free = [(i, 0 if i in taken else f, total) for i, f, total in free]
+        placed.append((container_name, model, chosen))
+    return placed
+
+
+def launch_verifier(
+    client: docker.DockerClient,
+    image_name: str,
+    model: str,
+    container_name: str,
+    port: int,
+    gpus: List[Tuple[int, int, int]],
+) -> Container:
+    "Starts a verifier container without waiting for it to load"
+
+    # Delete if existing and out of date
+    existing_containers = named_containers(client, container_name)
+    if len(existing_containers):
+        existing_containers[0].remove(force=True)
+
+    # Init new container
+    bt.logging.info(
+        f"Loading {container_name} on gpu(s) {[gpu[0] for gpu in gpus]}"
+    )
+    config: Dict[str, Any] = {
+        "image": image_name,
+        "ports": {f"80/tcp": port},
+        "environment": [
+            f"MODEL={model}",
+            f"TENSOR_PARALLEL={len(gpus)}",
+        ],
+        "volumes": ["/var/targon/huggingface/cache:/root/.cache/huggingface"],
+        "runtime": "nvidia",
+        "detach": True,
+        "ipc_mode": "host",
+        "name": container_name,
+        "extra_hosts": {"host.docker.internal": "host-gateway"},
+        "labels": {"model": str(model), "port": str(port)},
+        "device_requests": [
+            DeviceRequest(
+                device_ids=[str(gpu[0]) for gpu in gpus], capabilities=[["gpu"]]
+            )
+        ],
+    }
+    return client.containers.run(**config)  # type: ignore
+
+
+def wait_for_verifiers(
+    client: docker.DockerClient,
+    pending: Dict[str, Tuple[str, Verifier]],
+    since: float,
+    on_healthy: Callable[[str, Verifier], None],
+    timeout: float = VERIFIER_STARTUP_TIMEOUT,
+):
+    """
+    Follows docker's event stream until every pending container is healthy
+    or has failed, calling `on_healthy` with the model and verifier as each
+    one comes up. `pending` maps container ids to their model and verifier.
+    Containers still starting after `timeout` are removed.
+    """
+    if not len(pending):
+        return
+    events = client.events(
+        since=int(since),
+        until=int(since + timeout),
+        decode=True,
+        filters={"type": "container", "label": "model"},
+    )
+    try:
+        for event in events:
+            container_id = event.get("Actor", {}).get("ID", event.get("id"))
+            if container_id not in pending:
+                continue
+            model, verifier = pending[container_id]
+            action = event.get("Action", event.get("status", ""))
+            if action == "health_status: healthy":
+                del pending[container_id]
+                bt.logging.info(f"{verifier.name} is healthy")
+                on_healthy(model, verifier)
+            elif action in ("health_status: unhealthy", "die", "destroy"):
+                del pending[container_id]
+                bt.logging.error(
+                    f"Failed starting container {verifier.name}: Removing from verifiers"
+                )
+                try:
+                    container_logs = client.containers.get(container_id).logs()  # type: ignore
+                    bt.logging.error("---- Verifier Logs ----")
+                    bt.logging.error(container_logs)
+                    bt.logging.error("-----------------------")
+                except Exception:
+                    pass
+            if not len(pending):
+                break
+    finally:
+        events.close()
+
+    for container_id, (_, verifier) in pending.items():
+        bt.logging.error(f"{verifier.name} did not start in {timeout}s, removing")
+        try:
+            client.containers.get(container_id).remove(force=True)  # type: ignore
+        except Exception:
+            pass
+
 
 def sync_output_checkers(
-    client: docker.DockerClient, models: List[str]
+    client: docker.DockerClient,
+    models: List[str],
+    replicas: int = 1,
+    remote: Optional[Dict[str, List[str]]] = None,
+    verification_ports: Optional[Dict[str, Dict[str, Any]]] = None,
+    apply: Callable[[Callable[[], None]], Any] = lambda change: change(),
 ) -> Dict[str, Dict[str, Any]]:
+    """
+    Starts `replicas` local verifiers per model, GPU space permitting, and
+    pools them with any remote verifiers for the model. Maps every model with
+    at least one verifier to its pool and supported endpoints.
+
+    Results go into `verification_ports` as they are known, models as soon
+    as their first verifier is healthy, so the dict in use can be passed in
+    and keeps serving while containers start. Its pools are updated in place,
+    so verifiers kept across syncs keep their load and backoff. Every change
+    to it is made through `apply`, which blocks until the change is made;
+    the validator uses it to make them on its runtime loop.
+
+    Replaced containers are drained before they are removed and new ones are
+    waited on, so this can take a long time and should get a thread of its
+    own.
+    """
+    remote = remote or {}
+    if verification_ports is None:
+        verification_ports = {}
 
-    # Get new image hash (if any)
+    # Pull the image only if it changed upstream
     image_name = f"{MANIFOLD_VERIFIER}:{IMAGE_TAG}"
-    try:
-        client.images.pull(image_name)  # type: ignore
-    except Exception as e:
-        bt.logging.error(str(e))
+    image = pull_if_changed(client, image_name)
     bt.logging.info(f"Syncing {models}")
 
-    # Remove all containers
-    remove_containers(client)
-    verification_ports = {}
-    used_ports = []
+    # Keep healthy containers that are still wanted and on the current image,
+    # they keep serving through the sync
+    desired = {
+        verifier_name(model, replica): model
+        for model in models
+        for replica in range(replicas)
+    }
+    kept, retiring = reconcile_containers(
+        client, desired, image.id if image else None
+    )
+    used_ports = [int(container.labels.get("port", 0)) for container in kept.values()]
     random.shuffle(models)
     min_port = 5555
 
-    # Clear containers that arent running
-    client.containers.prune()
-
-    # Load all models
-    bt.logging.info(f"Starting subset of {list(models)}")
+    # What is already running, with the endpoints of every model that has any
+    wanted_verifiers: Dict[str, List[Verifier]] = {}
+    endpoints: Dict[str, Any] = {}
     for model in models:
-        container_name = re.sub(r"[\W_]", "-", model).lower()
+        verifiers: List[Verifier] = []
+        for replica in range(replicas):
+            container = kept.get(verifier_name(model, replica))
+            if container is not None:
+                port = container.labels.get("port")
+                verifiers.append(
+                    Verifier(f"http://localhost:{port}", name=container.name)
+                )
+        verifiers += [Verifier(url) for url in remote.get(model, [])]
+        wanted_verifiers[model] = verifiers
+        if len(verifiers):
+            endpoints[model] = supported_endpoints(verifiers)
 
-        # Delete if existing and out of date
-        existing_containers: List[Container] = client.containers.list(filters={"name": container_name})  # type: ignore
-        if len(existing_containers):
-            existing_containers[0].remove(force=True)
+    pools: Dict[str, VerifierPool] = {}
+    draining: List[Tuple[Container, Optional[Verifier]]] = []
 
-        # Determine GPU free
-        free_gpus = get_free_gpus()
-        required_vram = estimate_max_size(model)
-        if required_vram is None:
-            bt.logging.error(f"Failed to find model {model}")
-            continue
-        gpus = get_gpu_with_space(free_gpus, required_vram)
-        if gpus is None:
-            bt.logging.info(f"Not enough space to run {model}")
-            continue
+    def publish_running():
+        # Verifiers of retiring containers are taken out of their pools here,
+        # keeping the objects to see when they are done
+        for container in retiring:
+            model = container.labels.get("model", "")
+            published = verification_ports.get(model)
+            url = f"http://localhost:{container.labels.get('port')}"
+            draining.append(
+                (container, published["pool"].get(url) if published else None)
+            )
+        for model in list(verification_ports.keys()):
+            if model not in models:
+                del verification_ports[model]
+        for model in models:
+            # Keep the pool in use, so verifiers still in it keep their state
+            published = verification_ports.get(model)
+            pools[model] = published["pool"] if published else VerifierPool(model, [])
+            pools[model].update(wanted_verifiers[model])
+            if endpoints.get(model) is not None:
+                verification_ports[model] = {
+                    "pool": pools[model],
+                    "endpoints": endpoints[model],
+                }
+            else:
+                verification_ports.pop(model, None)
 
+    apply(publish_running)
+    drain_containers(draining)
+
+    # Clear containers that arent running
+    client.containers.prune()
+
+    # First replicas of every model before second ones, in case GPUs run out
+    wanted = [
+        (verifier_name(model, replica), model)
+        for replica in range(replicas)
+        for model in models
+        if verifier_name(model, replica) not in kept
+    ]
+    bt.logging.info(f"Keeping {list(kept.keys())}, starting {[w[0] for w in wanted]}")
+    since = time.time()
+    pending: Dict[str, Tuple[str, Verifier]] = {}
+    for container_name, model, gpus in place_verifiers(wanted, get_free_gpus()):
         # Find Port
         while min_port in used_ports:
             min_port += 1
         used_ports.append(min_port)
-
-        # Init new container
-        bt.logging.info(
-            f"Loading {model} on gpu(s) {[gpu[0] for gpu in gpus]}"
+        try:
+            container = launch_verifier(
+                client, image_name, model, container_name, min_port, gpus
+            )
+        except Exception as e:
+            bt.logging.error(f"Failed starting container {container_name}: {e}")
+            continue
+        pending[container.id] = (
+            model,
+            Verifier(f"http://localhost:{min_port}", name=container_name),
         )
-        config: Dict[str, Any] = {
-            "image": image_name,
-            "ports": {f"80/tcp": min_port},
-            "environment": [
-                f"MODEL={model}",
-                f"TENSOR_PARALLEL={len(gpus)}",
-            ],
-            "volumes": ["/var/targon/huggingface/cache:/root/.cache/huggingface"],
-            "runtime": "nvidia",
-            "detach": True,
-            "ipc_mode": "host",
-            "name": container_name,
-            "extra_hosts": {"host.docker.internal": "host-gateway"},
-            "labels": {"model": str(model), "port": str(min_port)},
-            "device_requests": [
-                DeviceRequest(
-                    device_ids=[str(gpu[0]) for gpu in gpus], capabilities=[["gpu"]]
-                )
-            ],
-        }
-        client.containers.run(**config)  # type: ignore
-        while True:
-            ready = True
-            std_model = re.sub(r"[\W_]", "-", model).lower()
-            containers: List[Container] = client.containers.list(filters={"name": std_model}, all=True)  # type: ignore
-            if not len(containers):
-                bt.logging.info(
-                    f"Failed starting container {std_model}: Removing from verifiers"
-                )
-                break
-            (container,) = containers
-            if container.health == "unhealthy":
-                container_logs = container.logs()
-                bt.logging.error(
-                    f"Failed starting container {std_model}: Removing from verifiers"
-                )
-                bt.logging.error("---- Verifier Logs ----")
-                bt.logging.error(container_logs)
-                bt.logging.error("-----------------------")
-                break
-            if container.health != "healthy":
-                bt.logging.info(f"{container.name}: {container.health}")
-                ready = False
-            if ready:
-                verification_ports[model] = {"port": min_port}
-                endpoints = requests.get(
-                    f"http://localhost:{min_port}/endpoints"
-                ).json()
-                endpoints = [Endpoints(e.upper()) for e in endpoints]
-                verification_ports[model]["endpoints"] = endpoints
-                break
-            bt.logging.info("Checking again in 5 seconds")
-            sleep(5)
 
-    bt.logging.info("Successfully started verifiers")
+    def on_healthy(model: str, verifier: Verifier):
+        pool = pools[model]
+        model_endpoints = None
+        if model not in verification_ports:
+            model_endpoints = supported_endpoints([verifier])
+
+        def add():
+            pool.verifiers.append(verifier)
+            if model not in verification_ports and model_endpoints is not None:
+                verification_ports[model] = {
+                    "pool": pool,
+                    "endpoints": model_endpoints,
+                }
+
+        apply(add)
+
+    wait_for_verifiers(client, pending, since, on_healthy)
+
+    bt.logging.info("Successfully synced verifiers")
     bt.logging.info(str(verification_ports))
     if len(list(verification_ports.keys())) == 0:
         bt.logging.error("No verification ports")
-        exit()
     return verification_ports
@@ -1,39 +1,53 @@
+import asyncio
+import gzip
+import json
+import os
+from threading import Lock
+import time
 from typing import Any, Dict, List, Optional, Tuple
 
 import aiohttp
+import httpx
+import ijson
 import traceback
 from nanoid import generate
 
 from targon.epistula import generate_header
+from targon.ledger import OrganicLedger, organic_record_id
 from targon.request import check_tokens
+from targon.runtime import AsyncRuntime
 from targon.types import Endpoints, InferenceStats, OrganicStats
 import bittensor as bt
 
 JUGO_URL = "https://jugo.targon.com"
 
+# Concurrent verifications per verifier, and how long any one may take
+ORGANICS_CONCURRENCY = 8
+ORGANICS_TIMEOUT = 120
+
 
 async def send_organics_to_jugo(
     wallet: "bt.wallet",
     organics: List[OrganicStats],
+    session: aiohttp.ClientSession,
 ):
     try:
         body = {"organics": [organic.model_dump() for organic in organics]}
         headers = generate_header(wallet.hotkey, body)
         # Send request to the FastAPI server
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{JUGO_URL}/organics/scores",
-                headers=headers,
-                json=body,
-                timeout=aiohttp.ClientTimeout(60),
-            ) as response:
-                if response.status == 200:
-                    bt.logging.info("Records sent successfully.")
-                else:
-                    error_detail = await response.text()
-                    bt.logging.error(
-                        f"Error sending records: {response.status} - {error_detail}"
-                    )
+        async with session.post(
+            f"{JUGO_URL}/organics/scores",
+            headers=headers,
+            json=body,
+            timeout=aiohttp.ClientTimeout(60),
+        ) as response:
+            if response.status == 200:
+                bt.logging.info("Records sent successfully.")
+            else:
+                error_detail = await response.text()
+                bt.logging.error(
+                    f"Error sending records: {response.status} - {error_detail}"
+                )
 
     except aiohttp.ClientConnectionError:
         bt.logging.error("Error conecting to jugo, offline.")
@@ -42,7 +56,7 @@ async def send_organics_to_jugo(
         bt.logging.error(traceback.format_exc())
 
 
-async def send_stats_to_jugo(
+def create_stats_body(
     metagraph: "bt.metagraph",
     subtensor: "bt.subtensor",
     wallet: "bt.wallet",
@@ -52,188 +66,617 @@ async def send_stats_to_jugo(
     version: int,
     models: List[str],
     miner_tps: Dict[int, Dict[str, List[Optional[float]]]],
-):
-    try:
-        r_nanoid = generate(size=48)
-        responses = [
-            {
-                "r_nanoid": r_nanoid,
-                "hotkey": metagraph.axons[uid].hotkey,
-                "coldkey": metagraph.axons[uid].coldkey,
-                "uid": int(uid),
-                "stats": stat and stat.model_dump(),
-            }
-            for uid, stat in stats
-        ]
-        request = {
+) -> Dict[str, Any]:
+    r_nanoid = generate(size=48)
+    responses = [
+        {
             "r_nanoid": r_nanoid,
-            "block": subtensor.block,
-            "request": req,
-            "request_endpoint": str(endpoint),
-            "version": version,
-            "hotkey": wallet.hotkey.ss58_address,
+            "hotkey": metagraph.axons[uid].hotkey,
+            "coldkey": metagraph.axons[uid].coldkey,
+            "uid": int(uid),
+            "stats": stat and stat.model_dump(),
         }
-        # Prepare the data
-        body = {
-            "request": request,
-            "responses": responses,
-            "models": models,
-            "scores": miner_tps,
+        for uid, stat in stats
+    ]
+    request = {
+        "r_nanoid": r_nanoid,
+        "block": subtensor.block,
+        "request": req,
+        "request_endpoint": str(endpoint),
+        "version": version,
+        "hotkey": wallet.hotkey.ss58_address,
+    }
+    return {
+        "request": request,
+        "responses": responses,
+        "models": models,
+        # Copied, miner_tps keeps changing until the round is uploaded
+        "scores": {
+            uid: {model: list(tps) for model, tps in models.items()}
+            for uid, models in miner_tps.items()
+        },
+    }
+
+
+class ScoreDeltas:
+    """
+    Encodes miner_tps as only the entries that changed since the last upload
+    jugo acknowledged, instead of the whole table every round.
+
+    Each encoding has a `seq`, and `base_seq` names the acknowledged snapshot
+    the entries apply to. Applying `entries` on top of that snapshot gives the
+    full table at `seq`, where a `None` value means the uid or model was
+    removed. Every `full_every` rounds, or while nothing has been acknowledged,
+    the whole table is sent with `full` set.
+
+    Rounds are encoded as they are uploaded, so seqs never outlive the
+    process: rounds spooled before a restart are encoded again after it.
+    """
+
+    def __init__(self, full_every: int = 100, max_pending: int = 50):
+        self.full_every = full_every
+        self.max_pending = max_pending
+        self.lock = Lock()
+        self.seq = 0
+        self.acked_seq: Optional[int] = None
+        self.acked: Dict[int, Dict[str, List[Optional[float]]]] = {}
+        self.pending: Dict[int, Dict[int, Dict[str, List[Optional[float]]]]] = {}
+
+    def encode(
+        self, miner_tps: Dict[int, Dict[str, List[Optional[float]]]]
+    ) -> Dict[str, Any]:
+        snapshot = {
+            uid: {model: list(tps) for model, tps in models.items()}
+            for uid, models in miner_tps.items()
         }
-        headers = generate_header(wallet.hotkey, body)
-        # Send request to the FastAPI server
-        async with aiohttp.ClientSession() as session:
+        with self.lock:
+            self.seq += 1
+            full = self.acked_seq is None or self.seq % self.full_every == 0
+            entries: Dict[int, Any] = snapshot
+            if not full:
+                entries = {}
+                for uid, models in snapshot.items():
+                    acked = self.acked.get(uid, {})
+                    changed: Dict[str, Any] = {
+                        model: tps
+                        for model, tps in models.items()
+                        if acked.get(model) != tps
+                    }
+                    for model in acked:
+                        if model not in models:
+                            changed[model] = None
+                    if len(changed):
+                        entries[uid] = changed
+                for uid in self.acked:
+                    if uid not in snapshot:
+                        entries[uid] = None
+
+            self.pending[self.seq] = snapshot
+            for seq in sorted(self.pending)[: -self.max_pending]:
+                del self.pending[seq]
+            return {
+                "seq": self.seq,
+                "base_seq": None if full else self.acked_seq,
+                "full": full,
+                "entries": entries,
+            }
+
+    def ack(self, seq: int):
+        with self.lock:
+            if self.acked_seq is not None and seq <= self.acked_seq:
+                return
+            snapshot = self.pending.get(seq)
+            if snapshot is None:
+                return
+            self.acked = snapshot
+            self.acked_seq = seq
+            for pending in [s for s in self.pending if s <= seq]:
+                del self.pending[pending]
+
+    def on_uploaded(self, rounds: List[Dict[str, Any]]):
+        seqs = [r["scores"]["seq"] for r in rounds if "scores" in r]
+        if len(seqs):
+            self.ack(max(seqs))
+
+
+class JugoUploader:
+    """
+    Uploads round stats to jugo in the background so a slow or offline jugo
+    never stalls querying.
+
+    Rounds are batched into a single gzipped request to jugo's `/batch`,
+    their scores encoded by `score_deltas` when given. While jugo does not
+    serve `/batch`, rounds go one by one to its per round endpoint with full
+    scores, and `/batch` is tried again every `batch_retry_interval`. Batches
+    that fail to send are spooled to disk with their full scores, oldest
+    dropped past `max_spooled`, and retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        wallet: "bt.wallet",
+        spool_dir: str,
+        batch_size: int = 5,
+        flush_interval: float = 60,
+        max_spooled: int = 500,
+        max_backoff: float = 600,
+        score_deltas: Optional[ScoreDeltas] = None,
+        batch_retry_interval: float = 3600,
+    ):
+        self.wallet = wallet
+        self.score_deltas = score_deltas
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_spooled = max_spooled
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.retry_at = 0.0
+        self.batch_retry_interval = batch_retry_interval
+        self.batch_retry_at = 0.0
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def start(self, runtime: AsyncRuntime):
+        self.loop = runtime.loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        runtime.submit(self.run(runtime.session))
+
+    def submit(self, body: Dict[str, Any]):
+        "Thread safe, returns immediately"
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, body)
+
+    def stop(self):
+        "Spool anything not yet uploaded so it is sent after a restart"
+        try:
+            asyncio.run_coroutine_threadsafe(self.spool_queued(), self.loop).result(5)
+        except Exception as e:
+            bt.logging.error(f"Failed spooling jugo uploads: {e}")
+
+    async def spool_queued(self):
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if len(batch):
+            self.spool(self.encode(batch))
+
+    async def run(self, session: aiohttp.ClientSession):
+        while True:
+            try:
+                batch = await self.collect()
+                if len(batch):
+                    data = self.encode(batch)
+                    if self.failures or not await self.upload(session, data):
+                        self.spool(data)
+                if time.monotonic() >= self.retry_at:
+                    await self.drain_spool(session)
+            except Exception as e:
+                bt.logging.error(f"Error in jugo uploader: {e}")
+                bt.logging.error(traceback.format_exc())
+
+    async def collect(self) -> List[Dict[str, Any]]:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def encode(self, batch: List[Dict[str, Any]]) -> bytes:
+        return gzip.compress(json.dumps({"rounds": batch}).encode("utf-8"))
+
+    async def upload(self, session: aiohttp.ClientSession, data: bytes) -> bool:
+        "Returns False if the upload should be retried"
+        rounds = json.loads(gzip.decompress(data))["rounds"]
+        try:
+            if time.monotonic() < self.batch_retry_at:
+                status = await self.upload_rounds(session, rounds)
+            else:
+                status = await self.upload_batch(session, rounds)
+                if status in (404, 405):
+                    # Jugo does not serve batches yet, use the per round
+                    # endpoint until it is worth asking again
+                    bt.logging.warning("Jugo has no batch endpoint, sending rounds")
+                    self.batch_retry_at = time.monotonic() + self.batch_retry_interval
+                    status = await self.upload_rounds(session, rounds)
+            if status == 200:
+                bt.logging.info("Records sent successfully.")
+                self.failures = 0
+                return True
+            if status < 500:
+                # Retrying a rejected batch will not help
+                return True
+        except aiohttp.ClientConnectionError:
+            bt.logging.error("Error conecting to jugo, offline.")
+        except Exception as e:
+            bt.logging.error(f"Error uploading to jugo: {e}")
+        self.failures += 1
+        self.retry_at = time.monotonic() + min(
+            2**self.failures, self.max_backoff
+        )
+        return False
+
+    async def upload_batch(
+        self, session: aiohttp.ClientSession, rounds: List[Dict[str, Any]]
+    ) -> int:
+        if self.score_deltas is not None:
+            rounds = [
+                {**r, "scores": self.score_deltas.encode(r["scores"])}
+                for r in rounds
+            ]
+        # Sign the uncompressed body, that is what jugo verifies against
+        raw = json.dumps({"rounds": rounds}).encode("utf-8")
+        headers = generate_header(self.wallet.hotkey, raw)
+        headers["Content-Type"] = "application/json"
+        headers["Content-Encoding"] = "gzip"
+        async with session.post(
+            f"{JUGO_URL}/batch",
+            headers=headers,
+            data=gzip.compress(raw),
+            timeout=aiohttp.ClientTimeout(60),
+        ) as response:
+            if response.status == 200:
+                if self.score_deltas is not None:
+                    self.score_deltas.on_uploaded(rounds)
+            else:
+                error_detail = await response.text()
+                bt.logging.error(
+                    f"Error sending records: {response.status} - {error_detail}"
+                )
+            return response.status
+
+    async def upload_rounds(
+        self, session: aiohttp.ClientSession, rounds: List[Dict[str, Any]]
+    ) -> int:
+        """
+        Posts each round on its own with its full scores, stopping at the
+        first that fails. Rounds before it are sent again on retry, jugo can
+        tell them apart by their r_nanoid.
+        """
+        for body in rounds:
+            headers = generate_header(self.wallet.hotkey, body)
             async with session.post(
                 f"{JUGO_URL}/",
                 headers=headers,
                 json=body,
                 timeout=aiohttp.ClientTimeout(60),
             ) as response:
-                if response.status == 200:
-                    bt.logging.info("Records sent successfully.")
-                else:
+                if response.status != 200:
                     error_detail = await response.text()
                     bt.logging.error(
                         f"Error sending records: {response.status} - {error_detail}"
                     )
+                    return response.status
+        return 200
+
+    def spooled(self) -> List[str]:
+        return sorted(
+            os.path.join(self.spool_dir, name)
+            for name in os.listdir(self.spool_dir)
+            if name.endswith(".json.gz")
+        )
+
+    def spool(self, data: bytes):
+        path = os.path.join(self.spool_dir, f"{time.time_ns()}.json.gz")
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+        spooled = self.spooled()
+        for old in spooled[: max(0, len(spooled) - self.max_spooled)]:
+            bt.logging.warning(f"Jugo spool full, dropping {old}")
+            os.remove(old)
+
+    async def drain_spool(self, session: aiohttp.ClientSession, limit: int = 10):
+        for path in self.spooled()[:limit]:
+            with open(path, "rb") as file:
+                data = file.read()
+            if not await self.upload(session, data):
+                return
+            os.remove(path)
+
+
+def parse_organic_tokens(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+    "Pull the verifiable tokens out of an organic record's streamed response"
+    tokens = []
+    for token in record["response"]:
+        choice = token.get("choices", [{}])[0]
+        text = ""
+        logprob = -100
+        match record["endpoint"]:
+            case "CHAT":
+                text = choice.get("delta", {}).get("content")
+                logprobs = choice.get("logprobs")
+                if logprobs is None:
+                    continue
+                logprob = logprobs.get("content", [{}])[0].get("logprob", -100)
+                token = logprobs.get("content", [{}])[0].get("token", None)
+                if text is None or (text == "" and len(tokens) == 0):
+                    continue
+            case "COMPLETION":
+                text = choice.get("text")
+                logprobs = choice.get("logprobs")
+                if logprobs is None:
+                    continue
+                logprob = logprobs.get("token_logprobs", [-100])[0]
+                token = logprobs.get("tokens", [""])[0]
+                if text is None or (text == "" and len(tokens) == 0):
+                    continue
+
+        token_id = -1
+        if not token.startswith("token_id:"):
+            continue
+        token_parts = token.split(":")
+        if len(token_parts) > 1:
+            token_id = int(token_parts[1])
+
+        tokens.append(
+            {
+                "text": text,
+                "logprob": logprob,
+                "token_id": token_id,
+            }
+        )
+    return tokens
+
+
+class UnscorableOrganic(Exception):
+    "An organic record that verified, but lacks what its score is computed from"
 
-    except aiohttp.ClientConnectionError:
-        bt.logging.error("Error conecting to jugo, offline.")
-    except Exception as e:
-        bt.logging.error(f"Error in send_stats_to_jugo: {e}")
-        bt.logging.error(traceback.format_exc())
 
+async def score_organic(
+    model: str,
+    record: Dict[str, Any],
+    tokens: List[Dict[str, Any]],
+    ports: Dict[str, Dict[str, Any]],
+    semaphore: asyncio.Semaphore,
+    timeout: float,
+    client: Optional[httpx.AsyncClient] = None,
+) -> Tuple[Optional[float], Optional[OrganicStats]]:
+    """
+    Returns the score to record for the miner, if any, and the stats for jugo.
+    `tokens` are the record's parsed response tokens, see `compact_organic`.
+    Raises UnscorableOrganic if the record verified but can't be scored.
+    """
+    if not record["success"]:
+        return -500, None
 
-async def score_organics(last_bucket_id, ports, wallet):
+    # No response tokens
+    if len(tokens) == 0:
+        return -100, None
+
+    pool = ports.get(model, {}).get("pool")
+    if not pool:
+        return None, None
     try:
-        async with aiohttp.ClientSession() as session:
-            body = list(ports.keys())
-            headers = generate_header(wallet.hotkey, body)
+        async with semaphore:
+            res = await asyncio.wait_for(
+                check_tokens(
+                    record["request"],
+                    tokens,
+                    record["uid"],
+                    Endpoints(record["endpoint"]),
+                    pool,
+                    client=client,
+                    priority="organic",
+                ),
+                timeout,
+            )
+    except asyncio.TimeoutError:
+        bt.logging.error(f"Timed out verifying organic for {record['uid']}")
+        return None, None
+    bt.logging.info(str(res))
+    if res is None:
+        return None, None
+    verified = res.get("verified", False)
+    tps = 0
+    score = None
+    if verified:
+        try:
+            response_tokens_count = int(record.get("response_tokens") or 0)
+            tps = min(response_tokens_count, record["request"]["max_tokens"]) / (
+                int(record.get("total_time")) / 1000
+            )
+        except Exception as e:
+            raise UnscorableOrganic(f"Error scoring record: {e}") from e
+
+        # This shouldnt happen
+        if response_tokens_count == 0:
+            raise UnscorableOrganic("Record has no response tokens")
+        score = tps
+    return score, OrganicStats(
+        time_to_first_token=int(record.get("time_to_first_token")),
+        time_for_all_tokens=int(record.get("total_time"))
+        - int(record.get("time_to_first_token")),
+        total_time=int(record.get("total_time")),
+        tps=tps,
+        tokens=[],
+        verified=verified,
+        error=res.get("error"),
+        cause=res.get("cause"),
+        model=model,
+        max_tokens=record.get("request").get("max_tokens"),
+        seed=record.get("request").get("seed"),
+        temperature=record.get("request").get("temperature"),
+        uid=record["uid"],
+        hotkey=record.get("hotkey"),
+        coldkey=record.get("coldkey"),
+        endpoint=record.get("endpoint"),
+        total_tokens=record.get("response_tokens"),
+    )
+
+
+def same_bucket(bucket_id, last_bucket_id) -> bool:
+    # Bucket ids restored from the ledger are strings
+    return last_bucket_id is not None and str(bucket_id) == str(last_bucket_id)
+
+
+def compact_organic(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Parses the record's tokens and drops its raw streamed response, which is
+    by far the largest part of a record and is not needed past this point.
+    """
+    tokens = parse_organic_tokens(record) if record.get("success") else []
+    record["response"] = None
+    return tokens
+
+
+async def stream_organics(
+    stream: aiohttp.StreamReader,
+    last_bucket_id,
+    queue: "asyncio.Queue[Optional[Tuple[Any, str, Dict[str, Any], List[Dict[str, Any]]]]]",
+) -> Tuple[Any, int]:
+    """
+    Incrementally parses a `{"bucket_id": ..., "organics": {model: [record]}}`
+    body, putting each compacted record on `queue` as soon as it is complete,
+    along with the bucket id if it has been read yet. The queue is bounded,
+    so reading stalls while verification catches up.
+
+    Returns the bucket id and number of records read. Stops early when the
+    bucket id arrives before the records and matches `last_bucket_id`.
+    """
+    bucket_id = None
+    model = None
+    builder = None
+    depth = 0
+    count = 0
+    async for prefix, event, value in ijson.parse_async(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            if depth:
+                continue
+            record = builder.value
+            builder = None
+            count += 1
+            await queue.put((bucket_id, model, record, compact_organic(record)))
+        elif prefix == "bucket_id" and event not in ("start_map", "map_key"):
+            bucket_id = value
+            if same_bucket(bucket_id, last_bucket_id) and count == 0:
+                break
+        elif prefix == "organics" and event == "map_key":
+            model = value
+        elif model is not None and event == "start_map" and prefix.startswith(
+            "organics."
+        ):
+            # Start of a record in the model's list
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            depth = 1
+    return bucket_id, count
+
+
+async def score_organics(
+    last_bucket_id,
+    ports,
+    wallet,
+    client: httpx.AsyncClient,
+    session: aiohttp.ClientSession,
+    ledger: Optional[OrganicLedger] = None,
+    concurrency: int = ORGANICS_CONCURRENCY,
+    timeout: float = ORGANICS_TIMEOUT,
+):
+    try:
+        body = list(ports.keys())
+        headers = generate_header(wallet.hotkey, body)
+        semaphores = {model: asyncio.Semaphore(concurrency) for model in ports}
+        workers = concurrency * max(len(ports), 1)
+
+        # Only this many records are held in memory at once, regardless of
+        # the size of the bucket.
+        queue: asyncio.Queue = asyncio.Queue(maxsize=workers)
+        scores: Dict[int, List[float]] = {}
+        organic_stats: List[OrganicStats] = []
+        # Records scored before the bucket id was read, for the ledger once
+        # it is known
+        unrecorded: List[Tuple[str, int, float]] = []
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                # A bad record must not stop the worker, or reading the bucket
+                # blocks on the full queue forever
+                try:
+                    await score_record(*item)
+                except Exception as e:
+                    bt.logging.error(f"Failed scoring organic: {e}")
+                    bt.logging.error(traceback.format_exc())
+
+        async def score_record(bucket_id, model, record, tokens):
+            uid = record["uid"]
+            if scores.get(uid) is None:
+                scores[uid] = []
+            record_id = organic_record_id(record)
+            seen = ledger.get(bucket_id, record_id) if ledger else None
+            if seen is not None:
+                # Verified before a restart, reuse the score
+                scores[uid].append(seen[1])
+                return
+            try:
+                score, organic_stat = await score_organic(
+                    model,
+                    record,
+                    tokens,
+                    ports,
+                    semaphores.setdefault(model, asyncio.Semaphore(concurrency)),
+                    timeout,
+                    client,
+                )
+            except UnscorableOrganic as e:
+                bt.logging.error(f"{uid}: {e}")
+                return
+            if score is not None:
+                scores[uid].append(score)
+            if organic_stat is not None:
+                organic_stats.append(organic_stat)
+            # Records without a score are retried after a restart
+            if ledger and score is not None:
+                if bucket_id is None:
+                    unrecorded.append((record_id, uid, score))
+                else:
+                    ledger.record(bucket_id, record_id, uid, score)
+
+        tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+        try:
+            # The body is read while records are verified, so only bound
+            # the time between reads, not the whole request.
             async with session.post(
                 JUGO_URL + "/organics",
                 headers=headers,
                 json=body,
-                timeout=aiohttp.ClientTimeout(60),
+                timeout=aiohttp.ClientTimeout(
+                    total=None, sock_connect=60, sock_read=60
+                ),
             ) as res:
                 if res.status != 200:
-                    bt.logging.info(f"Error pinging jugo {res.text}")
+                    bt.logging.info(f"Error pinging jugo {await res.text()}")
                     return last_bucket_id, None, None
-                res_body = await res.json()
-        bucket_id = res_body.get("bucket_id")
-        organics = res_body.get("organics")
-        if last_bucket_id == bucket_id:
+                bucket_id, count = await stream_organics(
+                    res.content, last_bucket_id, queue
+                )
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if same_bucket(bucket_id, last_bucket_id):
             bt.logging.info(f"Already seen this bucket id")
             return last_bucket_id, None, None
-        scores = {}
-        organic_stats = []
-        bt.logging.info(f"Found {len(organics)} organics")
-        for model, records in organics.items():
-            for record in records:
-                uid = record["uid"]
-                if scores.get(uid) is None:
-                    scores[uid] = []
-                if not record["success"]:
-                    scores[uid].append(-500)
-                    continue
-                tokens = []
-                for token in record["response"]:
-                    choice = token.get("choices", [{}])[0]
-                    text = ""
-                    logprob = -100
-                    match record["endpoint"]:
-                        case "CHAT":
-                            text = choice.get("delta", {}).get("content")
-                            logprobs = choice.get("logprobs")
-                            if logprobs is None:
-                                continue
-                            logprob = logprobs.get("content", [{}])[0].get(
-                                "logprob", -100
-                            )
-                            token = logprobs.get("content", [{}])[0].get("token", None)
-                            if text is None or (text == "" and len(tokens) == 0):
-                                continue
-                        case "COMPLETION":
-                            text = choice.get("text")
-                            logprobs = choice.get("logprobs")
-                            if logprobs is None:
-                                continue
-                            logprob = logprobs.get("token_logprobs", [-100])[0]
-                            token = logprobs.get("tokens", [""])[0]
-                            if text is None or (text == "" and len(tokens) == 0):
-                                continue
-
-                    token_id = -1
-                    if not token.startswith("token_id:"):
-                        continue
-                    token_parts = token.split(":")
-                    if len(token_parts) > 1:
-                        token_id = int(token_parts[1])
-
-                    tokens.append(
-                        {
-                            "text": text,
-                            "logprob": logprob,
-                            "token_id": token_id,
-                        }
-                    )
-
-                # No response tokens
-                if len(tokens) == 0:
-                    scores[uid].append(-100)
-                    continue
-
-                port = ports.get(model, {}).get("port")
-                if not port:
-                    continue
-                res = await check_tokens(
-                    record["request"],
-                    tokens,
-                    record["uid"],
-                    Endpoints(record["endpoint"]),
-                    port,
-                )
-                bt.logging.info(str(res))
-                if res is None:
-                    continue
-                verified = res.get("verified", False)
-                tps = 0
-                if verified:
-                    try:
-                        response_tokens_count = int(record.get("response_tokens", 0))
-
-                        # This shouldnt happen
-                        if response_tokens_count == 0:
-                            continue
-
-                        tps = min(
-                            response_tokens_count, record["request"]["max_tokens"]
-                        ) / (int(record.get("total_time")) / 1000)
-                        scores[uid].append(tps)
-                    except Exception as e:
-                        bt.logging.error("Error scoring record: " + str(e))
-                        continue
-                organic_stats.append(
-                    OrganicStats(
-                        time_to_first_token=int(record.get("time_to_first_token")),
-                        time_for_all_tokens=int(record.get("total_time"))
-                        - int(record.get("time_to_first_token")),
-                        total_time=int(record.get("total_time")),
-                        tps=tps,
-                        tokens=[],
-                        verified=verified,
-                        error=res.get("error"),
-                        cause=res.get("cause"),
-                        model=model,
-                        max_tokens=record.get("request").get("max_tokens"),
-                        seed=record.get("request").get("seed"),
-                        temperature=record.get("request").get("temperature"),
-                        uid=uid,
-                        hotkey=record.get("hotkey"),
-                        coldkey=record.get("coldkey"),
-                        endpoint=record.get("endpoint"),
-                        total_tokens=record.get("response_tokens"),
-                    )
-                )
+        if ledger and bucket_id is not None:
+            for record_id, uid, score in unrecorded:
+                ledger.record(bucket_id, record_id, uid, score)
+            ledger.complete(bucket_id)
+        bt.logging.info(f"Scored {count} organics")
         bt.logging.info(f"{bucket_id}: {scores}")
         return bucket_id, scores, organic_stats
     except Exception as e:
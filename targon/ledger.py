@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+import bittensor as bt
+
+
+def organic_record_id(record: Dict[str, Any]) -> str:
+    "Jugo's id for the record, or a stable hash of it for records without one"
+    if record.get("id") is not None:
+        return str(record["id"])
+    content = {k: v for k, v in record.items() if k != "response"}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class OrganicLedger:
+    """
+    Organic records already verified, per bucket, persisted so a restarted
+    validator does not verify them again.
+
+    Each bucket maps record id to the uid and score it produced, so the
+    organic scores for a bucket can be rebuilt without the verifiers. Only the
+    most recent `max_buckets` buckets are kept.
+
+    Not thread safe, only used from the validator's async runtime.
+    """
+
+    def __init__(self, path: str, max_buckets: int = 6, save_interval: float = 10):
+        self.path = path
+        self.max_buckets = max_buckets
+        self.save_interval = save_interval
+        self.buckets: Dict[str, Dict[str, Any]] = {}
+        self.dirty = False
+        self.last_saved = 0.0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                self.buckets = json.load(file).get("buckets", {})
+        except IOError:
+            bt.logging.info("No organics ledger found")
+        except Exception as e:
+            bt.logging.error(f"Failed reading organics ledger: {e}")
+            bt.logging.error(traceback.format_exc())
+
+    def save(self, force: bool = True):
+        if not self.dirty:
+            return
+        if not force and time.monotonic() - self.last_saved < self.save_interval:
+            return
+        try:
+            with open(self.path + ".tmp", "w") as file:
+                json.dump({"buckets": self.buckets}, file)
+            os.replace(self.path + ".tmp", self.path)
+            self.dirty = False
+            self.last_saved = time.monotonic()
+        except Exception as e:
+            bt.logging.error(f"Failed writing organics ledger: {e}")
+
+    def bucket(self, bucket_id) -> Dict[str, Any]:
+        key = str(bucket_id)
+        if key not in self.buckets:
+            self.buckets[key] = {"complete": False, "records": {}}
+            # Dicts keep insertion order, so the oldest buckets come first
+            for old in list(self.buckets)[: -self.max_buckets]:
+                del self.buckets[old]
+        return self.buckets[key]
+
+    def get(self, bucket_id, record_id: str) -> Optional[List[Any]]:
+        "[uid, score] if the record was already verified"
+        if bucket_id is None:
+            return None
+        return self.buckets.get(str(bucket_id), {}).get("records", {}).get(record_id)
+
+    def record(self, bucket_id, record_id: str, uid: int, score: Optional[float]):
+        self.bucket(bucket_id)["records"][record_id] = [uid, score]
+        self.dirty = True
+        self.save(force=False)
+
+    def complete(self, bucket_id):
+        self.bucket(bucket_id)["complete"] = True
+        self.dirty = True
+        self.save()
+
+    def latest(self) -> Optional[str]:
+        if not self.buckets:
+            return None
+        return list(self.buckets)[-1]
+
+    def is_complete(self, bucket_id) -> bool:
+        return self.buckets.get(str(bucket_id), {}).get("complete", False)
+
+    def scores(self, bucket_id) -> Dict[int, List[float]]:
+        "Organic scores per uid, in the same shape score_organics returns"
+        scores: Dict[int, List[float]] = {}
+        records = self.buckets.get(str(bucket_id), {}).get("records", {})
+        for uid, score in records.values():
+            scores.setdefault(uid, [])
+            if score is not None:
+                scores[uid].append(score)
+        return scores
@@ -0,0 +1,73 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+TPS_BUCKETS = (5, 10, 20, 30, 40, 50, 60, 80, 100, 150, 200, 300)
+
+# Only requests that passed the sender check are labeled by validator, so
+# unknown callers cannot grow the number of series.
+AUTH_LATENCY = Histogram(
+    "targon_miner_auth_seconds",
+    "Time spent verifying the sender and signature of a request",
+    ["validator"],
+    buckets=LATENCY_BUCKETS,
+)
+QUEUE_WAIT = Histogram(
+    "targon_miner_queue_wait_seconds",
+    "Time requests spent waiting for an upstream slot",
+    ["validator"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_TTFT = Histogram(
+    "targon_miner_upstream_ttft_seconds",
+    "Time from sending a request upstream to its first streamed byte",
+    ["validator", "model"],
+    buckets=LATENCY_BUCKETS,
+)
+STREAMED_TPS = Histogram(
+    "targon_miner_streamed_tokens_per_second",
+    "Streamed events per second after the first byte, roughly tokens per second",
+    ["validator", "model"],
+    buckets=TPS_BUCKETS,
+)
+REQUESTS = Counter(
+    "targon_miner_requests",
+    "Inference requests proxied upstream",
+    ["validator", "model"],
+)
+BYTES_PROXIED = Counter(
+    "targon_miner_proxied_bytes",
+    "Response bytes streamed back to validators",
+    ["validator", "model"],
+)
+REJECTIONS = Counter(
+    "targon_miner_rejections",
+    "Requests rejected before reaching the upstream",
+    ["reason"],
+)
+QUEUE_DEPTH = Gauge(
+    "targon_miner_queue_depth",
+    "Requests waiting for an upstream slot",
+)
+ACTIVE_REQUESTS = Gauge(
+    "targon_miner_active_requests",
+    "Requests currently being proxied upstream",
+)
+
+
+def start_metrics_server(port: int):
+    "Serves /metrics on localhost only"
+    start_http_server(port, addr="127.0.0.1")
@@ -0,0 +1,78 @@
+import time
+from typing import Dict, List, Optional
+
+import httpx
+import bittensor as bt
+
+
+class ModelRegistry:
+    """
+    In-memory view of the models served by the miner's upstream backends, and
+    of the models validators have asked the miner to serve.
+
+    Backends are polled through their openai compatible `/models` route at most
+    once per ttl, so `GET /models` can always be answered from memory.
+    """
+
+    def __init__(self, endpoints: List[str], api_key: str, ttl: float = 60):
+        self.endpoints = endpoints
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.ttl = ttl
+        self.last_refresh = 0.0
+
+        # model -> endpoint serving it
+        self.models: Dict[str, str] = {}
+
+        # validator hotkey -> (models requested, time received)
+        self.requested: Dict[str, tuple[List[str], float]] = {}
+
+    def refresh(self, force=False) -> bool:
+        if not force and time.time() - self.last_refresh < self.ttl:
+            return False
+        models: Dict[str, str] = {}
+        for endpoint in self.endpoints:
+            try:
+                res = httpx.get(f"{endpoint}/models", headers=self.headers, timeout=3)
+                res.raise_for_status()
+                for model in res.json().get("data", []):
+                    models.setdefault(model["id"], endpoint)
+            except Exception as e:
+                bt.logging.error(f"Failed listing models from {endpoint}: {e}")
+
+                # Keep advertising what this backend served last time, a single
+                # failed poll should not drop the miner off of every model.
+                for model, model_endpoint in self.models.items():
+                    if model_endpoint == endpoint:
+                        models.setdefault(model, endpoint)
+
+        if models.keys() != self.models.keys():
+            bt.logging.info(f"Serving models: {sorted(models.keys())}")
+        # Swap instead of mutating so readers never see a partial dict
+        self.models = models
+        self.last_refresh = time.time()
+        return True
+
+    def list(self) -> List[str]:
+        return list(self.models.keys())
+
+    def endpoint_for(self, model: Optional[str]) -> Optional[str]:
+        if model is None:
+            return None
+        return self.models.get(model)
+
+    def record_request(
+        self, hotkey: str, models: List[str], received: Optional[float] = None
+    ):
+        self.requested[hotkey] = (models, received or time.time())
+
+    def demand(self) -> Dict[str, int]:
+        "Number of validators requesting each model"
+        counts: Dict[str, int] = {}
+        for models, _ in self.requested.values():
+            for model in set(models):
+                counts[model] = counts.get(model, 0) + 1
+        return counts
+
+    def missing(self) -> List[str]:
+        "Models validators want that no upstream backend is serving"
+        return [model for model in self.demand() if model not in self.models]
@@ -1,22 +1,49 @@
+import asyncio
+from contextlib import asynccontextmanager
 import math
 from os import urandom
 import time
 import traceback
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
+import httpx
 from httpx import Timeout
 import openai
-import requests
 from targon.dataset import create_query_prompt, create_search_prompt
 from targon.epistula import create_header_hook
+from targon.runtime import CONNECT_TIMEOUT
 from targon.types import Endpoints, InferenceStats
 from targon.utils import fail_with_none
+from targon.verifiers import Verifier, VerifierPool
 import random
 import bittensor as bt
 
 
+# Attempts at a verifier answering 429, and the longest Retry-After honored
+VERIFY_RETRIES = 5
+MAX_RETRY_AFTER = 30
+
+
+@asynccontextmanager
+async def maybe_client(client: Optional[httpx.AsyncClient]):
+    "Uses the shared client if given, otherwise a one-off client"
+    if client is not None:
+        yield client
+        return
+    async with httpx.AsyncClient(
+        timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT)
+    ) as one_off:
+        yield one_off
+
+
 @fail_with_none("Error generating dataset")
-def generate_request(dataset, model_name, endpoint: Endpoints, port: int):
+async def generate_request(
+    dataset,
+    model_name,
+    endpoint: Endpoints,
+    verifier: VerifierPool,
+    client: Optional[httpx.AsyncClient] = None,
+):
     # Generate a random seed for reproducibility in sampling and text generation
     random.seed(urandom(100))
     seed = random.randint(10000, 10000000)
@@ -33,18 +60,20 @@ def generate_request(dataset, model_name, endpoint: Endpoints, port: int):
     response = None
     for _ in range(3):
         try:
-            response = requests.post(
-                f"http://localhost:{port}/generate",
-                headers={"Content-Type": "application/json"},
-                json={
-                    "messages": messages,
-                    "sampling_params": {
-                        "temperature": 0.5,
-                        "seed": seed,
-                        "max_tokens": random.randint(16, 64),
+            async with maybe_client(client) as http:
+                response = await verifier.post(
+                    http,
+                    "/generate",
+                    headers={"Content-Type": "application/json"},
+                    json={
+                        "messages": messages,
+                        "sampling_params": {
+                            "temperature": 0.5,
+                            "seed": seed,
+                            "max_tokens": random.randint(16, 64),
+                        },
                     },
-                },
-            )
+                )
             if response.status_code != 200:
                 bt.logging.error(f"Failed to generate request for {model_name}")
                 return None
@@ -76,6 +105,7 @@ async def handle_inference(
     request,
     uid: int,
     endpoint: Endpoints,
+    session: Optional["VerificationSession"] = None,
 ) -> Tuple[int, InferenceStats]:
     stats = InferenceStats(
         time_to_first_token=0,
@@ -142,6 +172,10 @@ async def handle_inference(
                             }
                         )
                         token_times.append(time.time())
+                        if session is not None:
+                            session.push(stats.tokens[-1])
+                            if session.abort is not None:
+                                break
                 case Endpoints.COMPLETION:
                     comp = await miner.completions.create(**request)
                     async for chunk in comp:
@@ -178,6 +212,10 @@ async def handle_inference(
                             }
                         )
                         token_times.append(time.time())
+                        if session is not None:
+                            session.push(stats.tokens[-1])
+                            if session.abort is not None:
+                                break
         except openai.APIConnectionError as e:
             bt.logging.trace(f"Miner {uid} failed request: {e}")
             stats.error = str(e)
@@ -187,6 +225,10 @@ async def handle_inference(
             stats.error = str(e)
             stats.cause = "BAD_STREAM"
 
+        if session is not None and session.abort is not None:
+            # Verifier already failed the stream, no need to read the rest
+            stats.error = session.abort["error"]
+            stats.cause = session.abort["cause"]
         if start_token_time == 0:
             start_token_time = time.time()
         end_token_time = time.time()
@@ -223,24 +265,292 @@ async def check_tokens(
     responses: List[Dict],
     uid,
     endpoint: Endpoints,
-    port: int,
-    url="http://localhost",
+    verifier: Union[VerifierPool, Verifier],
+    client: Optional[httpx.AsyncClient] = None,
+    priority: str = "synthetic",
 ) -> Optional[Dict]:
     try:
-        result = requests.post(
-            f"{url}:{port}/verify",
-            headers={"Content-Type": "application/json"},
-            json={
-                "model": request.get("model"),
-                "request_type": endpoint.value,
-                "request_params": request,
-                "output_sequence": responses,
-            },
-        ).json()
+        # Verification can wait on other requests at the verifier, so no timeout
+        # here. Callers that need a deadline should wrap this.
+        async with maybe_client(client) as http:
+            return await post_verification(
+                http,
+                verifier,
+                "/verify",
+                {
+                    "model": request.get("model"),
+                    "request_type": endpoint.value,
+                    "request_params": request,
+                    "output_sequence": responses,
+                    "priority": priority,
+                },
+                uid,
+            )
+    except Exception as e:
+        bt.logging.error(f"{uid}: " + str(e))
+        return None
+
+
+@fail_with_none("Failed to check tokens")
+async def check_tokens_batch(
+    request,
+    responses: List[List[Dict]],
+    uids: List,
+    endpoint: Endpoints,
+    verifier: VerifierPool,
+    client: Optional[httpx.AsyncClient] = None,
+    priority: str = "synthetic",
+) -> Optional[List[Optional[Dict]]]:
+    """
+    Verifies several miners' outputs to the same request in one call, so the
+    verifier can share work between them. Outputs it had no room for are
+    retried on their own through check_tokens. Returns None if the batch
+    call itself fails.
+    """
+    try:
+        async with maybe_client(client) as http:
+            res = await verifier.post(
+                http,
+                "/verify/batch",
+                headers={"Content-Type": "application/json"},
+                json={
+                    "model": request.get("model"),
+                    "request_type": endpoint.value,
+                    "request_params": request,
+                    "output_sequences": responses,
+                    "priority": priority,
+                },
+            )
+        if res.status_code != 200:
+            bt.logging.error(f"Batch verification failed: {res.text}")
+            return None
+        results = res.json()["results"]
+        if len(results) != len(responses):
+            bt.logging.error(f"Batch verification returned {len(results)} results")
+            return None
+    except Exception as e:
+        # The caller falls back to verifying each output on its own
+        bt.logging.error(f"Batch verification failed: {e}")
+        return None
+
+    async def settle(uid, tokens: List[Dict], result: Dict) -> Optional[Dict]:
+        if result.get("cause") == "OVERLOADED":
+            return await check_tokens(
+                request,
+                tokens,
+                uid,
+                endpoint,
+                verifier,
+                client=client,
+                priority=priority,
+            )
         if result.get("verified") is None:
-            bt.logging.error(str(result))
+            bt.logging.error(f"{uid}: {result}")
             return None
         return result
-    except Exception as e:
-        bt.logging.error(f"{uid}: " + str(e))
+
+    return list(
+        await asyncio.gather(
+            *[
+                settle(uid, tokens, result)
+                for uid, tokens, result in zip(uids, responses, results)
+            ]
+        )
+    )
+
+
+async def post_verification(
+    http: httpx.AsyncClient,
+    verifier: Union[VerifierPool, Verifier],
+    path: str,
+    body: Dict,
+    uid,
+) -> Optional[Dict]:
+    "Posts to a verifier endpoint answering with a verdict, honoring 429s"
+    for _ in range(VERIFY_RETRIES):
+        # A pool only answers 429 once all of its verifiers have
+        res = await verifier.post(
+            http, path, headers={"Content-Type": "application/json"}, json=body
+        )
+        if res.status_code != 429:
+            break
+        # Verifier is overloaded, come back when it says to
+        retry_after = min(float(res.headers.get("Retry-After", 1)), MAX_RETRY_AFTER)
+        bt.logging.info(f"{uid}: verifier overloaded, retrying in {retry_after}s")
+        await asyncio.sleep(retry_after)
+    else:
+        bt.logging.error(f"{uid}: verifier stayed overloaded")
+        return None
+    result = res.json()
+    if result.get("verified") is None:
+        bt.logging.error(str(result))
         return None
+    return result
+
+
+class VerificationSession:
+    """
+    Streams a miner's output to the verifier while it is still coming in, so
+    verification overlaps generation and a stream the verifier has already
+    failed can be cut short. Tokens are sent in chunks, one request at a time.
+    If the session can't be opened, finish falls back to check_tokens.
+
+    Sessions live on one verifier, so the whole session is pinned to the
+    least busy verifier in the pool and counts as outstanding work there.
+    """
+
+    def __init__(
+        self,
+        request,
+        uid,
+        endpoint: Endpoints,
+        pool: VerifierPool,
+        client: httpx.AsyncClient,
+        priority: str = "synthetic",
+        chunk_size: int = 16,
+    ):
+        self.request = request
+        self.uid = uid
+        self.endpoint = endpoint
+        self.pool = pool
+        self.verifier = pool.pick()
+        self.verifier.outstanding += 1
+        self.released = False
+        self.client = client
+        self.priority = priority
+        self.chunk_size = chunk_size
+        self.session_id: Optional[str] = None
+        self.failed = False
+        # Every token pushed, and those not yet sent
+        self.tokens: List[Dict] = []
+        self.buffer: List[Dict] = []
+        self.opening: Optional[asyncio.Task] = None
+        self.sending: Optional[asyncio.Task] = None
+        # Set to {"error", "cause"} once the verifier fails the stream
+        self.abort: Optional[Dict] = None
+
+    def start(self):
+        self.opening = asyncio.create_task(self.open())
+
+    async def open(self):
+        try:
+            res = await self.verifier.post(
+                self.client,
+                "/sessions",
+                json={
+                    "model": self.request.get("model"),
+                    "request_type": self.endpoint.value,
+                    "request_params": self.request,
+                    "priority": self.priority,
+                },
+            )
+            if res.status_code != 200:
+                bt.logging.info(
+                    f"{self.uid}: could not open verification session: {res.text}"
+                )
+                self.failed = True
+                return
+            self.session_id = res.json()["session_id"]
+        except Exception as e:
+            bt.logging.info(f"{self.uid}: could not open verification session: {e}")
+            self.failed = True
+
+    def push(self, token: Dict):
+        self.tokens.append(token)
+        self.buffer.append(token)
+        if self.failed or len(self.buffer) < self.chunk_size:
+            return
+        if self.sending is not None and not self.sending.done():
+            return
+        chunk = self.buffer
+        self.buffer = []
+        self.sending = asyncio.create_task(self.send(chunk))
+
+    async def send(self, chunk: List[Dict]):
+        if self.opening is not None:
+            await self.opening
+        if self.failed or self.session_id is None:
+            return
+        try:
+            res = await self.verifier.post(
+                self.client,
+                f"/sessions/{self.session_id}/tokens",
+                json={"tokens": chunk},
+            )
+            if res.status_code != 200:
+                self.failed = True
+                return
+            status = res.json()
+            if status.get("abort"):
+                self.abort = {"error": status.get("error"), "cause": status.get("cause")}
+        except Exception as e:
+            bt.logging.info(f"{self.uid}: verification session failed: {e}")
+            self.failed = True
+
+    async def finish(self) -> Optional[Dict]:
+        "Same verdict check_tokens would give for every token pushed"
+        if self.opening is not None:
+            await self.opening
+        if self.sending is not None:
+            await self.sending
+        # Last tokens go up on their own, so retrying finish after a 429
+        # doesn't add them twice
+        if len(self.buffer) and not self.failed:
+            chunk = self.buffer
+            self.buffer = []
+            await self.send(chunk)
+        if self.failed or self.session_id is None:
+            await self.close()
+            return await check_tokens(
+                self.request,
+                self.tokens,
+                self.uid,
+                self.endpoint,
+                self.pool,
+                client=self.client,
+                priority=self.priority,
+            )
+        try:
+            verdict = await post_verification(
+                self.client,
+                self.verifier,
+                f"/sessions/{self.session_id}/finish",
+                {"tokens": []},
+                self.uid,
+            )
+        except Exception as e:
+            bt.logging.error(f"{self.uid}: " + str(e))
+            verdict = None
+        if verdict is None:
+            # The verifier keeps sessions it could not finish
+            await self.close()
+            return None
+        # and drops the ones it did
+        self.session_id = None
+        self.release()
+        return verdict
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.verifier.outstanding -= 1
+
+    async def close(self):
+        """
+        Drops the session on the verifier, for streams that won't be verified.
+        Safe to call more than once, and after finish.
+        """
+        for task in (self.opening, self.sending):
+            if task is not None:
+                task.cancel()
+        self.release()
+        if self.session_id is None:
+            return
+        try:
+            await self.verifier.request(
+                self.client, "DELETE", f"/sessions/{self.session_id}"
+            )
+        except Exception:
+            pass
+        self.session_id = None
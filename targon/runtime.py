@@ -0,0 +1,70 @@
+import asyncio
+from concurrent.futures import Future
+from threading import Thread
+from typing import Any, Callable, Coroutine, Optional, TypeVar
+
+import aiohttp
+import httpx
+
+T = TypeVar("T")
+
+CONNECT_TIMEOUT = 5
+
+
+class AsyncRuntime:
+    """
+    One event loop on a background thread that owns all of a neuron's async
+    work, so connection pools survive between calls instead of being torn down
+    with a fresh loop each time.
+
+    Coroutines can be submitted from any thread. `http` and `session` are
+    shared clients bound to this loop and must only be used from coroutines
+    running on it.
+    """
+
+    http: httpx.AsyncClient
+    session: aiohttp.ClientSession
+
+    def __init__(self, name: str = "async-runtime"):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(name=name, target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.run(self.create_clients())
+
+    async def create_clients(self):
+        self.http = httpx.AsyncClient(
+            # Verifications can take minutes, but an unreachable host should
+            # fail over quickly
+            timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=256, max_keepalive_connections=64),
+        )
+        self.session = aiohttp.ClientSession()
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> "Future[T]":
+        "Schedules the coroutine without waiting for it"
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        "Runs the coroutine and blocks the calling thread until it finishes"
+        return self.submit(coro).result(timeout)
+
+    def call(self, func: Callable[[], T], timeout: Optional[float] = None) -> T:
+        """
+        Runs a plain function on the loop and blocks until it returns, for
+        changes to state that coroutines on the loop read
+        """
+
+        async def call():
+            return func()
+
+        return self.run(call(), timeout)
+
+    def stop(self):
+        async def close():
+            await self.http.aclose()
+            await self.session.close()
+
+        try:
+            self.run(close(), timeout=5)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
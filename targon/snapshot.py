@@ -0,0 +1,52 @@
+import json
+import multiprocessing as mp
+from typing import Any, Optional
+
+
+class SharedSnapshot:
+    """
+    JSON document published by one process and read by processes forked from it.
+
+    Readers only take the lock and decode when the version has moved, so
+    checking for a new snapshot on every request costs a single shared int read.
+    Must be created before forking.
+    """
+
+    def __init__(self, size: int = 2**20):
+        ctx = mp.get_context("fork")
+        self.lock = ctx.Lock()
+        self.version = ctx.Value("Q", 0, lock=False)
+        self.length = ctx.Value("Q", 0, lock=False)
+        self.buffer = ctx.Array("c", size, lock=False)
+        self.published: Optional[bytes] = None
+        self.local_version = 0
+        self.local_value: Any = None
+
+    def publish(self, value: Any) -> bool:
+        "Returns False if the value is unchanged from the last publish"
+        data = json.dumps(value).encode("utf-8")
+        if data == self.published:
+            return False
+        if len(data) > len(self.buffer):
+            raise ValueError(
+                f"Snapshot of {len(data)} bytes does not fit in {len(self.buffer)} bytes"
+            )
+        with self.lock:
+            self.buffer[: len(data)] = data
+            self.length.value = len(data)
+            self.version.value += 1
+        self.published = data
+        return True
+
+    def changed(self) -> bool:
+        return self.version.value != self.local_version
+
+    def read(self) -> Any:
+        if not self.changed():
+            return self.local_value
+        with self.lock:
+            data = self.buffer[: self.length.value]
+            version = self.version.value
+        self.local_value = json.loads(data)
+        self.local_version = version
+        return self.local_value
@@ -1,3 +1,4 @@
+import inspect
 import traceback
 import bittensor as bt
 
@@ -15,14 +16,28 @@ def print_info(metagraph, hotkey, block, isMiner=True):
 
 
 def fail_with_none(message: str = ""):
+    def log(e: Exception):
+        bt.logging.error(message)
+        bt.logging.error(str(e))
+        bt.logging.error(traceback.format_exc())
+
     def outer(func):
+        if inspect.iscoroutinefunction(func):
+
+            async def async_inner(*args, **kwargs):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    log(e)
+                    return None
+
+            return async_inner
+
         def inner(*args, **kwargs):
             try:
                 return func(*args, **kwargs)
             except Exception as e:
-                bt.logging.error(message)
-                bt.logging.error(str(e))
-                bt.logging.error(traceback.format_exc())
+                log(e)
                 return None
 
         return inner
@@ -0,0 +1,169 @@
+import time
+from typing import Dict, List, Optional
+
+import bittensor as bt
+import httpx
+
+from targon.types import Endpoints
+
+# Backoff after consecutive failures, doubling up to the max
+DOWN_BASE = 2.0
+DOWN_MAX = 60.0
+# A plain 500 is the verifier answering, and can come from a miner's output
+# it could not handle, so only these count against its health
+DOWN_STATUSES = (502, 503, 504)
+
+
+class Verifier:
+    """
+    One verifier container, local or on another host. Tracks requests in
+    flight and consecutive failures; a verifier that keeps failing is left
+    alone for a growing backoff before it is tried again. One answering 429
+    is tried last until its Retry-After passes.
+    """
+
+    def __init__(self, url: str, name: Optional[str] = None):
+        self.url = url.rstrip("/")
+        self.name = name or self.url
+        self.outstanding = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.busy_until = 0.0
+        self.last_used = 0.0
+
+    def __repr__(self):
+        return f"Verifier({self.name})"
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.down_until
+
+    def succeeded(self):
+        self.failures = 0
+        self.down_until = 0.0
+
+    def failed(self):
+        self.failures += 1
+        backoff = min(DOWN_BASE * 2 ** (self.failures - 1), DOWN_MAX)
+        self.down_until = time.monotonic() + backoff
+        bt.logging.info(f"{self.name} failed {self.failures}x, down for {backoff}s")
+
+    async def request(
+        self, http: httpx.AsyncClient, method: str, path: str, **kwargs
+    ) -> httpx.Response:
+        self.outstanding += 1
+        self.last_used = time.monotonic()
+        try:
+            res = await http.request(method, f"{self.url}{path}", **kwargs)
+        except httpx.TransportError:
+            self.failed()
+            raise
+        finally:
+            self.outstanding -= 1
+        if res.status_code in DOWN_STATUSES:
+            self.failed()
+            return res
+        if res.status_code >= 500:
+            return res
+        self.succeeded()
+        if res.status_code == 429:
+            try:
+                retry_after = float(res.headers.get("Retry-After", 1))
+            except ValueError:
+                retry_after = 1.0
+            self.busy_until = time.monotonic() + retry_after
+        return res
+
+    async def post(self, http: httpx.AsyncClient, path: str, **kwargs):
+        return await self.request(http, "POST", path, **kwargs)
+
+
+class VerifierPool:
+    """
+    Every verifier serving one model. Requests go to the healthy verifier
+    with the fewest requests in flight, least recently used on ties, and
+    fail over to the next one on connection errors, 5xx or 429. If none are
+    healthy the one coming back soonest is tried anyway.
+
+    Not thread safe, must only be used from the validator's runtime loop.
+    """
+
+    def __init__(self, model: str, verifiers: List[Verifier]):
+        self.model = model
+        self.verifiers = verifiers
+
+    def __repr__(self):
+        return f"VerifierPool({self.model}, {self.verifiers})"
+
+    def __len__(self):
+        return len(self.verifiers)
+
+    def get(self, url: str) -> Optional[Verifier]:
+        return next((v for v in self.verifiers if v.url == url.rstrip("/")), None)
+
+    def update(self, verifiers: List[Verifier]):
+        """
+        Swaps in the verifiers the model now has. Ones already in the pool are
+        kept as they are, so their load and health carry over.
+        """
+        self.verifiers = [self.get(verifier.url) or verifier for verifier in verifiers]
+
+    def ranked(self) -> List[Verifier]:
+        "Verifiers in the order they should be tried"
+        now = time.monotonic()
+        return sorted(
+            self.verifiers,
+            key=lambda v: (
+                not v.healthy(now),
+                v.down_until if not v.healthy(now) else 0,
+                now < v.busy_until,
+                v.outstanding,
+                v.last_used,
+            ),
+        )
+
+    def pick(self) -> Verifier:
+        return self.ranked()[0]
+
+    async def request(
+        self, http: httpx.AsyncClient, method: str, path: str, **kwargs
+    ) -> httpx.Response:
+        last_error: Optional[Exception] = None
+        res: Optional[httpx.Response] = None
+        for verifier in self.ranked():
+            try:
+                res = await verifier.request(http, method, path, **kwargs)
+            except httpx.TransportError as e:
+                last_error = e
+                continue
+            if res.status_code < 500 and res.status_code != 429:
+                return res
+        if res is not None:
+            return res
+        assert last_error is not None
+        raise last_error
+
+    async def post(self, http: httpx.AsyncClient, path: str, **kwargs):
+        return await self.request(http, "POST", path, **kwargs)
+
+
+def parse_remote_verifiers(entries: Optional[List[str]]) -> Dict[str, List[str]]:
+    "MODEL=URL entries, as given to --verifiers.remote"
+    remote: Dict[str, List[str]] = {}
+    for entry in entries or []:
+        model, sep, url = entry.partition("=")
+        if not sep or not model or not url:
+            raise ValueError(f"Expected MODEL=URL, got {entry}")
+        remote.setdefault(model, []).append(url)
+    return remote
+
+
+def supported_endpoints(verifiers: List[Verifier]) -> Optional[List[Endpoints]]:
+    "Endpoints the model's verifiers serve, asked from the first that answers"
+    for verifier in verifiers:
+        try:
+            res = httpx.get(f"{verifier.url}/endpoints", timeout=5)
+            res.raise_for_status()
+            return [Endpoints(e.upper()) for e in res.json()]
+        except Exception as e:
+            bt.logging.error(f"{verifier.name} did not list its endpoints: {e}")
+    return None
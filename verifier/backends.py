@@ -0,0 +1,191 @@
+import abc
+import asyncio
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, NamedTuple, Optional, Union
+from uuid import uuid4
+
+# Either text, or {"prompt_token_ids": [...]} to skip tokenization.
+Prompt = Union[str, Dict[str, List[int]]]
+
+
+@dataclass
+class Sampling:
+    temperature: float = 0.0
+    seed: int = 42
+    max_tokens: int = 1
+    # Number of top logprobs to return per generated / prompt token
+    logprobs: Optional[int] = None
+    prompt_logprobs: Optional[int] = None
+    detokenize: bool = True
+
+
+class Logprob(NamedTuple):
+    logprob: float
+    rank: Optional[int]
+
+
+class Completion(NamedTuple):
+    text: str
+    logprobs: Optional[List[Dict[int, Logprob]]]
+
+
+class Output(NamedTuple):
+    """
+    What generate returns, shaped like vLLM's RequestOutput. Top logprobs map
+    token id to its logprob and 1 based rank, and always include the token
+    that was actually prompted or sampled. The first prompt position is None.
+    """
+
+    prompt_logprobs: Optional[List[Optional[Dict[int, Logprob]]]]
+    outputs: List[Completion]
+
+
+class Backend(abc.ABC):
+    "Model the verifier runs against"
+
+    tokenizer: Any
+
+    @abc.abstractmethod
+    async def generate(self, prompt: Prompt, sampling: Sampling) -> Output:
+        pass
+
+
+class VLLMBackend(Backend):
+    """
+    vLLM's async engine, which batches concurrent requests together so
+    verifications don't wait on each other.
+    """
+
+    def __init__(self, model: str, tensor_parallel: int, prefix_caching: bool):
+        from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+
+        self.sampling_params = SamplingParams
+        self.engine = AsyncLLMEngine.from_engine_args(
+            AsyncEngineArgs(
+                model=model,
+                enforce_eager=True,
+                gpu_memory_utilization=0.9,
+                tensor_parallel_size=tensor_parallel,
+                enable_prefix_caching=prefix_caching,
+            )
+        )
+        self.tokenizer = self.engine.engine.get_tokenizer()
+
+    async def generate(self, prompt: Prompt, sampling: Sampling) -> Output:
+        params = self.sampling_params(
+            temperature=sampling.temperature,
+            seed=sampling.seed,
+            max_tokens=sampling.max_tokens,
+            logprobs=sampling.logprobs,
+            prompt_logprobs=sampling.prompt_logprobs,
+            detokenize=sampling.detokenize,
+        )
+        final = None
+        async for output in self.engine.generate(prompt, params, uuid4().hex):  # type: ignore
+            final = output
+        assert final is not None
+        # RequestOutput has the same shape
+        return final  # type: ignore
+
+
+class HFBackend(Backend):
+    """
+    Reference implementation on a transformers causal LM, meant for small
+    models on CPU so the request handling and scoring can be run and profiled
+    without a GPU. Requests are run one at a time.
+    """
+
+    def __init__(self, model: str, device: str = "cpu"):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.torch = torch
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(model)
+        self.model = AutoModelForCausalLM.from_pretrained(model).to(device).eval()
+        self.lock = threading.Lock()
+
+    async def generate(self, prompt: Prompt, sampling: Sampling) -> Output:
+        return await asyncio.to_thread(self.generate_sync, prompt, sampling)
+
+    def top_logprobs(self, logprobs, token_ids, k: int) -> List[Dict[int, Logprob]]:
+        "Top k logprobs of each row, plus the given token of each row"
+        torch = self.torch
+        token_ids = torch.tensor(token_ids, device=logprobs.device)
+        chosen = logprobs.gather(1, token_ids[:, None])
+        ranks = (logprobs > chosen).sum(-1) + 1
+        values, indices = logprobs.topk(k, dim=-1) if k else (None, None)
+        rows = []
+        for row in range(logprobs.shape[0]):
+            top = {}
+            if values is not None and indices is not None:
+                for rank, (token, value) in enumerate(
+                    zip(indices[row].tolist(), values[row].tolist())
+                ):
+                    top[token] = Logprob(value, rank + 1)
+            top[int(token_ids[row])] = Logprob(
+                float(chosen[row, 0]), int(ranks[row])
+            )
+            rows.append(top)
+        return rows
+
+    def generate_sync(self, prompt: Prompt, sampling: Sampling) -> Output:
+        torch = self.torch
+        if isinstance(prompt, dict):
+            ids = list(prompt["prompt_token_ids"])
+        else:
+            ids = self.tokenizer(prompt).input_ids
+
+        def scale(logits):
+            if sampling.temperature > 0:
+                logits = logits / sampling.temperature
+            return torch.log_softmax(logits.float(), dim=-1)
+
+        with self.lock, torch.inference_mode():
+            generator = torch.Generator(device=self.device).manual_seed(sampling.seed)
+            out = self.model(torch.tensor([ids], device=self.device), use_cache=True)
+
+            prompt_logprobs = None
+            if sampling.prompt_logprobs is not None:
+                prompt_logprobs = [None] + self.top_logprobs(
+                    scale(out.logits[0, :-1]), ids[1:], sampling.prompt_logprobs
+                )
+
+            tokens: List[int] = []
+            logprobs: Optional[List[Dict[int, Logprob]]] = None
+            if sampling.logprobs is not None:
+                logprobs = []
+            for _ in range(sampling.max_tokens):
+                step = scale(out.logits[0, -1:])
+                if sampling.temperature > 0:
+                    token = int(
+                        torch.multinomial(step.exp(), 1, generator=generator)[0, 0]
+                    )
+                else:
+                    token = int(step.argmax())
+                if logprobs is not None:
+                    logprobs += self.top_logprobs(step, [token], sampling.logprobs)
+                tokens.append(token)
+                if token == self.tokenizer.eos_token_id:
+                    break
+                out = self.model(
+                    torch.tensor([[token]], device=self.device),
+                    past_key_values=out.past_key_values,
+                    use_cache=True,
+                )
+
+        text = self.tokenizer.decode(tokens) if sampling.detokenize else ""
+        return Output(prompt_logprobs, [Completion(text, logprobs)])
+
+
+def load_backend(name: str, model: str, **kwargs) -> Backend:
+    if name == "vllm":
+        return VLLMBackend(
+            model,
+            tensor_parallel=kwargs.get("tensor_parallel", 1),
+            prefix_caching=kwargs.get("prefix_caching", False),
+        )
+    if name == "hf":
+        return HFBackend(model, device=kwargs.get("device", "cpu"))
+    raise ValueError(f"Unknown backend {name}, expected vllm or hf")
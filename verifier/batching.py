@@ -0,0 +1,121 @@
+import asyncio
+from dataclasses import astuple
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from backends import Completion, Logprob, Output, Prompt, Sampling
+
+# generate from verifier.py, taking the prompt, sampling and known positions
+Generate = Callable[[Prompt, Sampling, int], Awaitable[Output]]
+
+
+class PrefixTrie:
+    "Token trie of the output sequences in a batch"
+
+    def __init__(self):
+        self.root: Dict[int, dict] = {}
+
+    def insert(self, tokens: Sequence[int]):
+        node = self.root
+        for token in tokens:
+            node = node.setdefault(token, {})
+
+    def extend(self, tokens: Sequence[int]) -> Tuple[int, ...]:
+        """
+        A sequence in the trie that starts with `tokens`, down to a leaf.
+        Always the first branch, so every prefix of a leaf maps to that leaf.
+        """
+        node = self.root
+        for token in tokens:
+            node = node[token]
+        path = list(tokens)
+        while node:
+            token, node = next(iter(node.items()))
+            path.append(token)
+        return tuple(path)
+
+
+def prompt_key(prompt: Prompt):
+    if isinstance(prompt, dict):
+        return tuple(prompt["prompt_token_ids"])
+    return prompt
+
+
+class SharedGenerations:
+    """
+    Generations for the verifications of one batch, which all share the same
+    request and so the same input and sampling. Identical generate calls run
+    once, and the prompt logprobs of a sequence are read off the longest
+    sequence in the batch it is a prefix of, so a round of miners costs
+    about one prefill per leaf of their token trie instead of one per miner.
+    """
+
+    def __init__(
+        self,
+        generate: Generate,
+        sequences: List[Sequence[int]],
+        stop_tokens: Tuple[int, ...],
+    ):
+        self.run = generate
+        self.stop_tokens = stop_tokens
+        self.trie = PrefixTrie()
+        for tokens in sequences:
+            self.trie.insert(tokens)
+        self.calls: Dict[tuple, asyncio.Future] = {}
+
+    async def generate(
+        self, prompt: Prompt, sampling: Sampling, known: int = 0
+    ) -> Output:
+        key = (prompt_key(prompt), astuple(sampling))
+        call = self.calls.get(key)
+        if call is None:
+            call = self.calls[key] = asyncio.ensure_future(
+                self.run(prompt, sampling, known)
+            )
+        try:
+            # One verification giving up must not cancel it for the others
+            output = await asyncio.shield(call)
+        except Exception:
+            self.calls.pop(key, None)
+            raise
+        if sampling.prompt_logprobs is not None and output.prompt_logprobs is None:
+            # Let a retry run it again
+            self.calls.pop(key, None)
+        return output
+
+    async def prompt_logprobs(
+        self, input_tokens: List[int], tokens: Sequence[int], sampling: Sampling
+    ) -> Output:
+        """
+        Same as generating on the input followed by `tokens`. The longer
+        sequence's logprobs at the next position stand in for the generated
+        token's when they settle whether EOS / EOT is in the top logprobs,
+        otherwise this sequence is generated on its own.
+        """
+        path = self.trie.extend(tokens)
+        output = await self.generate(
+            {"prompt_token_ids": input_tokens + list(path)},
+            sampling,
+            len(input_tokens),
+        )
+        if len(path) == len(tokens) or output.prompt_logprobs is None:
+            return output
+        end = len(input_tokens) + len(tokens)
+        following = output.prompt_logprobs[end]
+        top = top_ranked(following, sampling.logprobs) if following else {}
+        if not any(token in top for token in self.stop_tokens):
+            return await self.generate(
+                {"prompt_token_ids": input_tokens + list(tokens)},
+                sampling,
+                len(input_tokens),
+            )
+        return Output(output.prompt_logprobs[:end], [Completion("", [top])])
+
+
+def top_ranked(
+    logprobs: Dict[int, Logprob], limit: Optional[int]
+) -> Dict[int, Logprob]:
+    return {
+        token: logprob
+        for token, logprob in logprobs.items()
+        if logprob.rank is not None and logprob.rank <= (limit or 0)
+    }
@@ -0,0 +1,108 @@
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_LATENCY = Histogram(
+    "targon_verifier_stage_seconds",
+    "Time spent in each stage of a verification",
+    ["model", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+QUEUE_WAIT = Histogram(
+    "targon_verifier_queue_wait_seconds",
+    "Time verifications waited for a slot on the engine",
+    ["model", "priority"],
+    buckets=LATENCY_BUCKETS,
+)
+GENERATE_CALLS = Histogram(
+    "targon_verifier_generate_calls",
+    "Engine generate calls made per verification",
+    ["model"],
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10),
+)
+VERIFICATIONS = Counter(
+    "targon_verifier_verifications",
+    "Finished verifications by outcome",
+    ["model", "priority", "cause"],
+)
+TOKENS_SCORED = Counter(
+    "targon_verifier_tokens_scored",
+    "Miner output tokens verified, rate() for tokens scored per second",
+    ["model"],
+)
+REJECTIONS = Counter(
+    "targon_verifier_rejections",
+    "Verifications turned away with a 429",
+    ["model", "priority"],
+)
+QUEUE_DEPTH = Gauge(
+    "targon_verifier_queue_depth",
+    "Verifications waiting for a slot on the engine",
+    ["model", "priority"],
+)
+ACTIVE = Gauge(
+    "targon_verifier_active",
+    "Verifications running on the engine",
+    ["model"],
+)
+
+
+class Timings:
+    "Per stage timings of one verification, logged as a single JSON line"
+
+    def __init__(self, model: str, priority: str, tokens: int):
+        self.model = model
+        self.priority = priority
+        self.tokens = tokens
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.generate_calls = 0
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0) + elapsed
+            STAGE_LATENCY.labels(model=self.model, stage=name).observe(elapsed)
+
+    def finish(self, cause: Optional[str]):
+        total = time.perf_counter() - self.start
+        cause = cause or "VERIFIED"
+        GENERATE_CALLS.labels(model=self.model).observe(self.generate_calls)
+        VERIFICATIONS.labels(
+            model=self.model, priority=self.priority, cause=cause
+        ).inc()
+        TOKENS_SCORED.labels(model=self.model).inc(self.tokens)
+        print(
+            json.dumps(
+                {
+                    "event": "verify",
+                    "model": self.model,
+                    "priority": self.priority,
+                    "cause": cause,
+                    "tokens": self.tokens,
+                    "generate_calls": self.generate_calls,
+                    "total_seconds": round(total, 4),
+                    "tokens_per_second": round(self.tokens / total, 2)
+                    if total
+                    else None,
+                    "stages": {k: round(v, 4) for k, v in self.stages.items()},
+                }
+            ),
+            flush=True,
+        )
+
+
+# Timings of the verification running in the current task, if any
+CURRENT_TIMINGS: ContextVar[Optional[Timings]] = ContextVar(
+    "current_timings", default=None
+)
@@ -0,0 +1,112 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List
+
+
+class Overloaded(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Scheduler:
+    """
+    Limits how many verifications run on the engine at once. Requests past
+    that wait in one bounded queue per priority class, and the highest class
+    with anything waiting is always served first, so a burst of low priority
+    work can't hold up the rest.
+
+    Requests that find their class's queue full, or that wait longer than
+    their class's deadline, raise Overloaded with a hint of how many seconds
+    to wait before retrying.
+    """
+
+    def __init__(
+        self,
+        max_active: int,
+        priorities: List[str],
+        max_queued: Dict[str, int],
+        deadlines: Dict[str, float],
+    ):
+        self.max_active = max_active
+        self.priorities = priorities
+        self.max_queued = max_queued
+        self.deadlines = deadlines
+        self.active = 0
+        self.waiting: Dict[str, Deque[asyncio.Future]] = {
+            priority: deque() for priority in priorities
+        }
+        # Moving average of how long a verification holds its slot
+        self.service_time = 5.0
+
+    def queued(self, priority: str) -> int:
+        return len(self.waiting[priority])
+
+    def has_free_slot(self) -> bool:
+        "Whether a request of any priority would start right away"
+        return self.active < self.max_active and not any(self.waiting.values())
+
+    def retry_after(self) -> int:
+        queued = sum(len(waiting) for waiting in self.waiting.values())
+        return max(1, math.ceil(self.service_time * (queued + 1) / self.max_active))
+
+    def ahead_of(self, priority: str) -> int:
+        "Requests that would be served before a new one of this priority"
+        ahead = 0
+        for other in self.priorities:
+            ahead += len(self.waiting[other])
+            if other == priority:
+                break
+        return ahead
+
+    @asynccontextmanager
+    async def slot(self, priority: str):
+        await self.acquire(priority)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.service_time = 0.9 * self.service_time + 0.1 * elapsed
+            self.release()
+
+    async def acquire(self, priority: str):
+        if self.active < self.max_active and not self.ahead_of(priority):
+            self.active += 1
+            return
+        if self.queued(priority) >= self.max_queued[priority]:
+            raise Overloaded(f"{priority} queue is full", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[priority].append(future)
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(future), timeout=self.deadlines[priority]
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Handed a slot just as we gave up, pass it on
+                self.release()
+            else:
+                future.cancel()
+                self.waiting[priority].remove(future)
+            if isinstance(e, asyncio.TimeoutError):
+                raise Overloaded(
+                    f"Waited over {self.deadlines[priority]}s in the {priority} queue",
+                    self.retry_after(),
+                )
+            raise
+
+    def release(self):
+        self.active -= 1
+        for priority in self.priorities:
+            waiting = self.waiting[priority]
+            while waiting and self.active < self.max_active:
+                future = waiting.popleft()
+                if future.done():
+                    continue
+                self.active += 1
+                future.set_result(None)
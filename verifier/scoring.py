@@ -0,0 +1,103 @@
+import math
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+# Ranks are 1 based. These mark a token missing from a position's top
+# logprobs, or present without a rank.
+ABSENT = 0
+UNRANKED = -1
+
+
+class TokenScores(NamedTuple):
+    # First position failing outright, and why. None if no position failed.
+    fail_idx: Optional[int]
+    fail_cause: Optional[str]
+    total_score: float
+    not_first: int
+    really_low_prob: int
+    perfect_tokens: int
+
+
+def exp(values: np.ndarray) -> np.ndarray:
+    # np.exp can differ from math.exp in the last bit, which is enough to
+    # move a score across a threshold, so stick to what the verifier used.
+    # This is the one step still run per token rather than vectorized.
+    return np.fromiter(map(math.exp, values.tolist()), np.float64, len(values))
+
+
+def eos_ranks(eos: np.ndarray, eot: np.ndarray) -> np.ndarray:
+    "Rank of EOS at each position, or of EOT where it is missing or ranks higher"
+    use_eot = ((eos == ABSENT) & (eot != ABSENT)) | (
+        (eos > 0) & (eot > 0) & (eot < eos)
+    )
+    return np.where(use_eot, eot, eos)
+
+
+def score_tokens(
+    ranks: np.ndarray,
+    eos: np.ndarray,
+    eot: np.ndarray,
+    expected: np.ndarray,
+    produced: np.ndarray,
+    top_logprobs: int,
+    temperature: float,
+) -> TokenScores:
+    """
+    Scores a miner's output tokens against the verifier's prompt logprobs.
+
+    All arrays have one entry per scored position: the rank of the miner's
+    token, EOS and EOT in the verifier's top logprobs (ABSENT or UNRANKED if
+    not known), the verifier's logprob of the miner's token and the logprob
+    the miner reported. Only positions up to `fail_idx` count towards totals.
+    """
+    ranks = np.asarray(ranks, dtype=np.int64)
+    eos_rank = eos_ranks(
+        np.asarray(eos, dtype=np.int64), np.asarray(eot, dtype=np.int64)
+    )
+    expected = np.asarray(expected, dtype=np.float64)
+    produced = np.asarray(produced, dtype=np.float64)
+
+    present = ranks != ABSENT
+    skipped_eos = (eos_rank != ABSENT) & (
+        ~present
+        | ((ranks > 0) & (eos_rank > 0) & (eos_rank < ranks) & (ranks > 10))
+    )
+    unlikely = present & (ranks >= 75) & ~skipped_eos
+
+    fail_idx = None
+    fail_cause = None
+    failed = np.flatnonzero(skipped_eos | unlikely)
+    if len(failed):
+        fail_idx = int(failed[0])
+        fail_cause = "SKIPPED_EOS_EOT" if skipped_eos[fail_idx] else "UNLIKELY_TOKEN"
+        ranks = ranks[:fail_idx]
+        present = present[:fail_idx]
+        expected = expected[:fail_idx]
+        produced = produced[:fail_idx]
+    if np.any(ranks == UNRANKED):
+        raise ValueError("Expected token logprob has no rank")
+
+    # Ranks from 25 up still count, ranks past top_logprobs below that don't
+    counted = present & ((ranks >= 25) | (ranks <= top_logprobs))
+    really_low_prob = int(np.count_nonzero(present & (ranks >= 25)))
+    not_first = int(np.count_nonzero(counted & (ranks != 1)))
+    perfect_tokens = int(np.count_nonzero(counted & (produced == 0)))
+
+    scores = 1.0 - np.minimum(1.0, np.abs(exp(expected) - exp(produced)))
+    # To accomodate architectural difference and such, >= 0.9 is perfect.
+    # Logprobs rarely match well for high temps, so rank 1 is enough there.
+    perfect = scores >= 0.9
+    if temperature >= 0.9:
+        perfect |= (ranks == 1) & (produced != 0)
+    scores = np.where(perfect, 1.0, scores)[counted]
+
+    # Summed in order, like a running total, so results match exactly
+    return TokenScores(
+        fail_idx=fail_idx,
+        fail_cause=fail_cause,
+        total_score=sum(scores.tolist(), 0.0),
+        not_first=not_first,
+        really_low_prob=really_low_prob,
+        perfect_tokens=perfect_tokens,
+    )
@@ -0,0 +1,181 @@
+import math
+import random
+from typing import Dict, List, NamedTuple, Optional
+
+import pytest
+
+from scoring import ABSENT, UNRANKED, score_tokens
+
+EOS = 1
+EOT = 2
+
+
+class Logprob(NamedTuple):
+    logprob: float
+    rank: Optional[int]
+
+
+def reference_scores(
+    positions: List[Dict[int, Logprob]],
+    tokens: List[int],
+    produced: List[float],
+    top_logprobs: int,
+    temperature: float,
+):
+    """
+    The per token loop verify_logprobs ran before scoring was moved to
+    scoring.py, returning what it accumulated or the first failure.
+    """
+    total_score = 0.0
+    perfect_tokens = 0
+    really_low_prob = 0
+    not_first = 0
+    for idx, (position, token_id, produced_logprob) in enumerate(
+        zip(positions, tokens, produced)
+    ):
+        eos_logprob = position.get(EOS)
+        eot_logprob = position.get(EOT)
+        if (
+            not eos_logprob
+            and eot_logprob
+            or (
+                eos_logprob
+                and eot_logprob
+                and eot_logprob.rank != None
+                and eos_logprob.rank != None
+                and eot_logprob.rank < eos_logprob.rank
+            )
+        ):
+            eos_logprob = eot_logprob
+        expected_logprob = position.get(token_id)
+        if eos_logprob and (
+            not expected_logprob
+            or (
+                eos_logprob
+                and expected_logprob.rank != None
+                and eos_logprob.rank != None
+                and eos_logprob.rank < expected_logprob.rank
+                and expected_logprob.rank > 10
+            )
+        ):
+            return idx, "SKIPPED_EOS_EOT", None
+        if expected_logprob is None:
+            continue
+        rank = expected_logprob.rank
+        assert rank != None
+        if rank >= 75:
+            return idx, "UNLIKELY_TOKEN", None
+        elif rank >= 25:
+            really_low_prob += 1
+        elif rank > top_logprobs:
+            continue
+        if rank != 1:
+            not_first += 1
+        score = 1.0 - min(
+            1.0, abs(math.exp(expected_logprob.logprob) - math.exp(produced_logprob))
+        )
+        if produced_logprob == 0:
+            perfect_tokens += 1
+        if score >= 0.9:
+            score = 1.0
+        if rank == 1 and temperature >= 0.9 and produced_logprob != 0:
+            score = 1.0
+        total_score += score
+    return None, None, (total_score, not_first, really_low_prob, perfect_tokens)
+
+
+def rank_of(logprob: Optional[Logprob]) -> int:
+    if logprob is None:
+        return ABSENT
+    if logprob.rank is None:
+        return UNRANKED
+    return logprob.rank
+
+
+def random_rank(rng: random.Random, unranked: float) -> Optional[int]:
+    if rng.random() < unranked:
+        return None
+    # Mostly top ranks, with the thresholds at 10, 25 and 75 well covered
+    return rng.choice([1, 1, 1, 2, 3, rng.randint(1, 12), rng.randint(1, 100)])
+
+
+def random_logprob(rng: random.Random) -> float:
+    return rng.choice([0.0, -rng.random() * 0.2, -rng.random() * 5, -1e-9])
+
+
+def random_case(rng: random.Random, unranked: float):
+    length = rng.randint(1, 40)
+    positions = []
+    tokens = []
+    produced = []
+    for _ in range(length):
+        token_id = rng.randint(3, 20)
+        position: Dict[int, Logprob] = {}
+        if rng.random() < 0.95:
+            position[token_id] = Logprob(
+                random_logprob(rng), random_rank(rng, unranked)
+            )
+        for special in (EOS, EOT):
+            if rng.random() < 0.1:
+                position[special] = Logprob(
+                    random_logprob(rng), random_rank(rng, unranked)
+                )
+        positions.append(position)
+        tokens.append(token_id)
+        # Miners often report the verifier's logprob, or one close to it
+        expected = position.get(token_id, Logprob(-3.0, None)).logprob
+        produced.append(
+            rng.choice([expected, expected - rng.random() * 0.05, random_logprob(rng)])
+        )
+    return positions, tokens, produced
+
+
+def score(positions, tokens, produced, top_logprobs, temperature):
+    return score_tokens(
+        [rank_of(position.get(token)) for position, token in zip(positions, tokens)],
+        [rank_of(position.get(EOS)) for position in positions],
+        [rank_of(position.get(EOT)) for position in positions],
+        [
+            position[token].logprob if token in position else 0.0
+            for position, token in zip(positions, tokens)
+        ],
+        produced,
+        top_logprobs,
+        temperature,
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_score_tokens_matches_reference_loop(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        positions, tokens, produced = random_case(rng, unranked=0)
+        temperature = rng.choice([0.0, 0.3, 0.9, 1.0, rng.random()])
+        top_logprobs = int(temperature * 10) + 6
+        fail_idx, fail_cause, totals = reference_scores(
+            positions, tokens, produced, top_logprobs, temperature
+        )
+        scores = score(positions, tokens, produced, top_logprobs, temperature)
+        assert (scores.fail_idx, scores.fail_cause) == (fail_idx, fail_cause)
+        if totals is not None:
+            assert (
+                scores.total_score,
+                scores.not_first,
+                scores.really_low_prob,
+                scores.perfect_tokens,
+            ) == totals
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_unranked_tokens_fail_like_reference_loop(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        positions, tokens, produced = random_case(rng, unranked=0.05)
+        try:
+            expected = reference_scores(positions, tokens, produced, 6, 0.0)
+        except AssertionError:
+            with pytest.raises(ValueError):
+                score(positions, tokens, produced, 6, 0.0)
+            continue
+        scores = score(positions, tokens, produced, 6, 0.0)
+        assert (scores.fail_idx, scores.fail_cause) == expected[:2]
@@ -1,13 +1,29 @@
 import random
-import math
 import os
 import asyncio
+import json
+import time
 import traceback
-from fastapi import FastAPI
+from functools import lru_cache
+from uuid import uuid4
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from prometheus_client import make_asgi_app
 from pydantic import BaseModel
 from enum import Enum
-from typing import Dict, List, Optional, Tuple
-from vllm import LLM, SamplingParams
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from backends import Output, Prompt, Sampling, load_backend
+from batching import SharedGenerations
+from metrics import (
+    ACTIVE,
+    CURRENT_TIMINGS,
+    QUEUE_DEPTH,
+    QUEUE_WAIT,
+    REJECTIONS,
+    Timings,
+)
+from scheduler import Overloaded, Scheduler
+from scoring import ABSENT, UNRANKED, TokenScores, score_tokens
 
 # Load the model.
 MODEL_NAME = os.getenv("MODEL", None)
@@ -18,24 +34,49 @@ if MODEL_NAME is None:
 LOGPROB_LOG_THRESHOLD = 0.65
 LOGPROB_FAILURE_THRESHOLD = 0.75
 TENSOR_PARALLEL = int(os.getenv("TENSOR_PARALLEL", 1))
-MODEL_WRAPPER = LLM(
-    model=MODEL_NAME,
-    enforce_eager=True,
-    gpu_memory_utilization=.9,
-    tensor_parallel_size=TENSOR_PARALLEL,
+# Reuse the KV cache of shared prompt prefixes, like the system prompt and the
+# prompt + output prefill repeated by the random checks. Prompt logprobs
+# missing for cached positions fail the verification as an internal error.
+PREFIX_CACHING = os.getenv("PREFIX_CACHING", "false").lower() == "true"
+# Output tokens scored in a first, short pass that can fail fast before the
+# full output is scored. 0 scores the full output straight away.
+STAGED_WINDOW = int(os.getenv("STAGED_WINDOW", 0))
+# Streaming sessions score their first SESSION_WINDOW tokens and again each
+# time the output doubles, and are dropped when idle for SESSION_TTL seconds.
+SESSION_WINDOW = int(os.getenv("SESSION_WINDOW", 64))
+SESSION_TTL = float(os.getenv("SESSION_TTL", 300))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", 1024))
+# `vllm`, or `hf` to run a small transformers model on CPU
+BACKEND = load_backend(
+    os.getenv("BACKEND", "vllm"),
+    MODEL_NAME,
+    tensor_parallel=TENSOR_PARALLEL,
+    prefix_caching=PREFIX_CACHING,
+    device=os.getenv("DEVICE", "cpu"),
 )
-TOKENIZER = MODEL_WRAPPER.get_tokenizer()
-MODEL = MODEL_WRAPPER.llm_engine.model_executor.driver_worker.model_runner.model  # type: ignore
-MODEL_NUM_PARAMS = sum(1 for _ in MODEL.parameters())
-
-# Lock to ensure atomicity.
-LOCK = asyncio.Lock()
-LOCK_GENERATE = asyncio.Lock()
+TOKENIZER = BACKEND.tokenizer
+EOS_TOKEN_ID = getattr(TOKENIZER, "eos_token_id", -1)
+EOT_TOKEN_ID = TOKENIZER.get_vocab().get("<|eot_id|>", -1)  # type: ignore
 
 ENDPOINTS = ["completion"]
 if TOKENIZER.chat_template is not None:
     ENDPOINTS.append("chat")
 
+# Verifications running on the engine at once. Past that, requests wait in a
+# bounded queue per priority, synthetic first, for at most their deadline.
+SCHEDULER = Scheduler(
+    max_active=int(os.getenv("MAX_ACTIVE", 32)),
+    priorities=["synthetic", "organic"],
+    max_queued={
+        "synthetic": int(os.getenv("SYNTHETIC_QUEUE", 256)),
+        "organic": int(os.getenv("ORGANIC_QUEUE", 64)),
+    },
+    deadlines={
+        "synthetic": float(os.getenv("SYNTHETIC_DEADLINE", 60)),
+        "organic": float(os.getenv("ORGANIC_DEADLINE", 30)),
+    },
+)
+
 
 class RequestParams(BaseModel):
     messages: Optional[List[Dict[str, str]]] = None
@@ -56,11 +97,27 @@ class RequestType(Enum):
     COMPLETION = "COMPLETION"
 
 
+class Priority(Enum):
+    SYNTHETIC = "synthetic"
+    ORGANIC = "organic"
+
+
 class VerificationRequest(BaseModel):
     request_type: str
     model: str = MODEL_NAME
     request_params: RequestParams
     output_sequence: List[OutputItem]
+    priority: Priority = Priority.SYNTHETIC
+
+
+class VerificationBatch(BaseModel):
+    "Outputs of several miners to the same request"
+
+    request_type: str
+    model: str = MODEL_NAME
+    request_params: RequestParams
+    output_sequences: List[List[OutputItem]]
+    priority: Priority = Priority.SYNTHETIC
 
 
 class RequestSamplingParams(BaseModel):
@@ -75,53 +132,105 @@ class GenerateRequest(BaseModel):
 
 
 app = FastAPI()
+app.mount("/metrics", make_asgi_app())
+ACTIVE.labels(model=MODEL_NAME).set_function(lambda: SCHEDULER.active)
+for priority in SCHEDULER.priorities:
+    QUEUE_DEPTH.labels(model=MODEL_NAME, priority=priority).set_function(
+        lambda priority=priority: SCHEDULER.queued(priority)
+    )
+
+
+async def generate(
+    prompt: Prompt, sampling_params: Sampling, known: int = 0
+) -> Output:
+    """
+    Generates on the backend, counting calls towards the current verification.
+    Prompt logprobs that don't line up with the prompt come back as None, the
+    same as when the backend returned none at all. Callers that don't read
+    the first `known` prompt positions, the input or positions they already
+    scored, get those as None when the backend left them out, as vLLM does
+    for positions served from its prefix cache.
+    """
+    timings = CURRENT_TIMINGS.get()
+    if timings is not None:
+        timings.generate_calls += 1
+    output = await BACKEND.generate(prompt, sampling_params)
+    if output.prompt_logprobs is None:
+        return output
+    prompt_logprobs = aligned_prompt_logprobs(prompt, output, known)
+    if prompt_logprobs is None:
+        print("Prompt logprobs do not cover the whole prompt, discarding them")
+        return Output(None, output.outputs)
+    if prompt_logprobs is not output.prompt_logprobs:
+        return Output(prompt_logprobs, output.outputs)
+    return output
+
+
+def aligned_prompt_logprobs(
+    prompt: Prompt, output: Output, known: int = 0
+) -> Optional[list]:
+    """
+    Prompt logprobs with one entry per prompt position, or None if positions
+    past the first `known` are missing. With prefix caching, vLLM can leave
+    out the leading positions served from the cache instead of padding them,
+    which would shift every rank read off of the list.
+    """
+    prompt_logprobs = output.prompt_logprobs
+    assert prompt_logprobs is not None
+    prompt_tokens = getattr(output, "prompt_token_ids", None)
+    if prompt_tokens is None and isinstance(prompt, dict):
+        prompt_tokens = prompt["prompt_token_ids"]
+    if prompt_tokens is not None and len(prompt_logprobs) != len(prompt_tokens):
+        missing = len(prompt_tokens) - len(prompt_logprobs)
+        if missing < 0 or missing > known:
+            return None
+        prompt_logprobs = [None] * missing + list(prompt_logprobs)
+    if any(position is None for position in prompt_logprobs[max(known, 1) :]):
+        return None
+    return prompt_logprobs
+
+
+def chat_prompt(messages: List[Dict[str, str]]) -> str:
+    prompt = TOKENIZER.apply_chat_template(
+        messages,  # type: ignore
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+    assert isinstance(prompt, str)
+    return prompt
 
 
 @app.post("/generate")
 async def generate_question(req: GenerateRequest):
-    async with LOCK_GENERATE:
-        try:
-            if "chat" in ENDPOINTS:
-                output = (
-                    MODEL_WRAPPER.chat(
-                        messages=req.messages, sampling_params=SamplingParams(**req.sampling_params.model_dump()), use_tqdm=False  # type: ignore
-                    )[0]
-                    .outputs[0]
-                    .text
-                )
-            else:
-                prompt = ""
-                for message in req.messages:
-                    prompt += (
-                        message.get("role", "")
-                        + ": "
-                        + message.get("content", "")
-                        + "\n"
-                    )
-                prompt += "\nResponse: "
-                output = (
-                    MODEL_WRAPPER.generate(
-                        prompts=prompt,
-                        sampling_params=SamplingParams(
-                            **req.sampling_params.model_dump()
-                        ),
-                        use_tqdm=False,
-                    )[0]
-                    .outputs[0]
-                    .text
+    try:
+        if "chat" in ENDPOINTS:
+            prompt = await asyncio.to_thread(chat_prompt, req.messages)
+        else:
+            prompt = ""
+            for message in req.messages:
+                prompt += (
+                    message.get("role", "") + ": " + message.get("content", "") + "\n"
                 )
-            return {"text": output}
-        except Exception as e:
-            print("Failed generate request", str(e), traceback.format_exc())
-        return {"text": None}
+            prompt += "\nResponse: "
+        output = await BACKEND.generate(
+            prompt, Sampling(**req.sampling_params.model_dump())
+        )
+        return {"text": output.outputs[0].text}
+    except Exception as e:
+        print("Failed generate request", str(e), traceback.format_exc())
+    return {"text": None}
 
 
-def verify_logprobs_random(
-    request: VerificationRequest, input_text: str
+async def verify_logprobs_random(
+    request: VerificationRequest,
+    input_text: str,
+    input_tokens: List[int],
+    shared: Optional[SharedGenerations] = None,
 ) -> Tuple[bool, str]:
     """
     Generate a handful of random outputs to ensure the logprobs weren't generated after the fact.
     """
+    run = shared.generate if shared is not None else generate
     indices = list(range(1, len(request.output_sequence) - 1))
     indices_to_check = list(
         sorted(
@@ -135,19 +244,27 @@ def verify_logprobs_random(
 
     # Generate a single token at each index, comparing logprobs.
     top_logprobs = int(request.request_params.temperature * 10) + 3
-    sampling_params = SamplingParams(
+    sampling_params = Sampling(
         temperature=request.request_params.temperature,
         seed=request.request_params.seed,
         max_tokens=1,
         logprobs=top_logprobs,
+        # Only token ids and ranks are compared, skip decoding the top tokens
+        detokenize=False,
     )
-    for idx in indices_to_check:
-        full_text = input_text + "".join(
-            [item.text for item in request.output_sequence[0:idx]]
-        )
-        output = MODEL_WRAPPER.generate([full_text], sampling_params, use_tqdm=False)[
-            0
-        ].outputs[0]
+    outputs = await asyncio.gather(
+        *[
+            run(
+                build_prompt(
+                    input_text, input_tokens, request.output_sequence[0:idx]
+                ),
+                sampling_params,
+            )
+            for idx in indices_to_check
+        ]
+    )
+    for idx, output in zip(indices_to_check, outputs):
+        output = output.outputs[0]
 
         # The miner's output token should be in the logprobs...
         top_tokens = []
@@ -165,118 +282,173 @@ def verify_logprobs_random(
     )
 
 
-def verify_logprobs(
-    request: VerificationRequest, input_text: str, input_tokens: List[int]
-) -> Optional[Tuple[bool, str, str]]:
-    """
-    Compare the produced logprob values against the ground truth, or at least
-    the ground truth according to this particular GPU/software pairing.
-    """
-
-    # Set up sampling parameters for the "fast" check, which just compares input logprobs against output logprobs.
+def prompt_logprob_sampling(
+    request: VerificationRequest,
+) -> Tuple[int, Sampling]:
+    "Sampling for the fast check, which scores the prompt logprobs"
     top_logprobs = int(request.request_params.temperature * 10) + 6
-    sampling_params = SamplingParams(
+    return top_logprobs, Sampling(
         temperature=request.request_params.temperature,
         seed=request.request_params.seed,
         max_tokens=1,
         logprobs=top_logprobs,
         prompt_logprobs=top_logprobs,
+        # Only token ids and ranks are compared, skip decoding the top tokens
+        # for every prompt position.
+        detokenize=False,
     )
 
+
+def score_positions(
+    request: VerificationRequest, positions: list, top_logprobs: int
+) -> Optional[Tuple[TokenScores, List[int]]]:
+    "Scores the miner's output tokens against the prompt logprobs at their positions"
+    # Checked by generate already, but never worth scoring the miner on
+    if any(position is None for position in positions):
+        return None
+    ranks = []
+    expected = []
+    for position, item in zip(positions, request.output_sequence):
+        logprob = position.get(item.token_id)
+        ranks.append(rank_of(logprob))
+        expected.append(logprob.logprob if logprob else 0.0)
+    scores = score_tokens(
+        ranks,
+        [rank_of(position.get(EOS_TOKEN_ID)) for position in positions],
+        [rank_of(position.get(EOT_TOKEN_ID)) for position in positions],
+        expected,
+        [item.logprob for item in request.output_sequence[: len(positions)]],
+        top_logprobs,
+        request.request_params.temperature,
+    )
+    return scores, ranks
+
+
+def hard_failure_message(
+    request: VerificationRequest, scores: TokenScores, ranks: List[int]
+) -> Optional[Tuple[bool, str, str]]:
+    if scores.fail_cause == "SKIPPED_EOS_EOT":
+        return (
+            False,
+            f"Expected EOS/EOT token at index {scores.fail_idx}",
+            "SKIPPED_EOS_EOT",
+        )
+    if scores.fail_idx is not None:
+        idx = scores.fail_idx
+        rank = ranks[idx]
+        return (
+            False,
+            f"Found extraordinarily improbable token '{TOKENIZER.decode([request.output_sequence[idx].token_id])}' at index {idx}: {rank=}",
+            "UNLIKELY_TOKEN",
+        )
+    return None
+
+
+def hard_failure(
+    request: VerificationRequest, positions: list, top_logprobs: int
+) -> Optional[Tuple[bool, str, str]]:
+    """
+    Failure from the rules that fail at the first offending token, judged
+    from a leading window of positions. Logprobs are causal, so a failure
+    here is the same failure the full sequence would have.
+    """
+    res = score_positions(request, positions, top_logprobs)
+    if res is None:
+        return None
+    return hard_failure_message(request, *res)
+
+
+async def verify_logprobs(
+    request: VerificationRequest,
+    input_text: str,
+    input_tokens: List[int],
+    shared: Optional[SharedGenerations] = None,
+    scored: Optional[list] = None,
+) -> Optional[Tuple[bool, str, str]]:
+    """
+    Compare the produced logprob values against the ground truth, or at least
+    the ground truth according to this particular GPU/software pairing.
+    `scored` are the prompt logprobs of leading output positions a session
+    already computed, which are reused instead of read off the full pass.
+    """
+    run = shared.generate if shared is not None else generate
+    scored = scored or []
+
+    # Set up sampling parameters for the "fast" check, which just compares input logprobs against output logprobs.
+    top_logprobs, sampling_params = prompt_logprob_sampling(request)
+
+    # Score a short leading window first, most broken or cheating outputs
+    # fail within it and never pay for the full prefill.
+    output_tokens = [item.token_id for item in request.output_sequence]
+    has_token_ids = all(token_id >= 0 for token_id in output_tokens)
+    staged = STAGED_WINDOW and len(output_tokens) - 3 > STAGED_WINDOW
+    if staged and has_token_ids and len(scored) < STAGED_WINDOW:
+        output = await run(
+            build_prompt(
+                input_text, input_tokens, request.output_sequence[:STAGED_WINDOW]
+            ),
+            sampling_params,
+            len(input_tokens),
+        )
+        if output.prompt_logprobs is not None:
+            failure = hard_failure(
+                request,
+                output.prompt_logprobs[len(input_tokens) :],
+                top_logprobs,
+            )
+            if failure is not None:
+                return failure
+
     # Generate output for a single token, which will return input logprobs based on prompt_logprobs=1
     output = None
     for _ in range(5):
-        full_text = input_text + "".join(
-            [item.text for item in request.output_sequence]
-        )
-        output = MODEL_WRAPPER.generate([full_text], sampling_params, use_tqdm=False)[0]
+        if shared is not None and has_token_ids:
+            output = await shared.prompt_logprobs(
+                input_tokens, output_tokens, sampling_params
+            )
+        elif len(scored):
+            # The scored positions may have been served from the prefix cache
+            prompt = build_prompt(input_text, input_tokens, request.output_sequence)
+            output = await generate(
+                prompt, sampling_params, known=len(input_tokens) + len(scored)
+            )
+        else:
+            prompt = build_prompt(input_text, input_tokens, request.output_sequence)
+            output = await run(prompt, sampling_params, len(input_tokens))
         if output.prompt_logprobs is not None:
             break
 
     if not output or output.prompt_logprobs is None:
         return None
+    prompt_logprobs = output.prompt_logprobs
+    if len(scored):
+        start = len(input_tokens)
+        prompt_logprobs = (
+            prompt_logprobs[:start] + scored + prompt_logprobs[start + len(scored) :]
+        )
 
     # The actual logprobs should be *very* close, but typically not 100% because of GPU/driver/etc. differences.
-    total_score = 0.0
     idxs = min(
-        len(output.prompt_logprobs) - len(input_tokens) - 3,
+        len(prompt_logprobs) - len(input_tokens) - 3,
         len(request.output_sequence) - 1,
     )
-    perfect_tokens = 0
-    eos_token_id = getattr(TOKENIZER, "eos_token_id", -1)
-    eot_token_id = TOKENIZER.get_vocab().get("<|eot_id|>", -1)  # type: ignore
-    output_tokens = [item.token_id for item in request.output_sequence]
-    really_low_prob = 0
-    not_first = 0
-    for idx in range(idxs):
-        item = request.output_sequence[idx]
-        expected_logprob = output.prompt_logprobs[idx + len(input_tokens)]
-        assert expected_logprob is not None
-        eos_logprob = expected_logprob.get(eos_token_id)
-        eot_logprob = expected_logprob.get(eot_token_id)
-        if (
-            not eos_logprob
-            and eot_logprob
-            or (
-                eos_logprob
-                and eot_logprob
-                and eot_logprob.rank != None
-                and eos_logprob.rank != None
-                and eot_logprob.rank < eos_logprob.rank
-            )
-        ):
-            eos_logprob = eot_logprob
-        expected_logprob = expected_logprob.get(item.token_id)
-        if eos_logprob and (
-            not expected_logprob
-            or (
-                eos_logprob
-                and expected_logprob.rank != None
-                and eos_logprob.rank != None
-                and eos_logprob.rank < expected_logprob.rank
-                and expected_logprob.rank > 10
-            )
-        ):
-            return False, f"Expected EOS/EOT token at index {idx}", "SKIPPED_EOS_EOT"
-        if expected_logprob is None:
-            continue
-        rank = expected_logprob.rank
-        assert rank != None
-        if rank >= 75:
-            return (
-                False,
-                f"Found extraordinarily improbable token '{TOKENIZER.decode([item.token_id])}' at index {idx}: {rank=}",
-                "UNLIKELY_TOKEN",
-            )
-        elif rank >= 25:
-            really_low_prob += 1
-        elif rank > top_logprobs:
-            continue
-        if rank != 1:
-            not_first += 1
-        expected_logprob = expected_logprob.logprob
-        produced_logprob = item.logprob
-        score = 1.0 - min(
-            1.0, abs(math.exp(expected_logprob) - math.exp(produced_logprob))
-        )
-
-        # Prevents over fitting smaller models
-        if produced_logprob == 0:
-            perfect_tokens += 1
-
-        # To accomodate architectural difference and such, we'll give a perfect score if >= 0.9
-        if score >= 0.9:
-            score = 1.0
-
-        # Logprobs rarely match well for high temps so we can use rank instead.
-        if (
-            rank == 1
-            and request.request_params.temperature >= 0.9
-            and produced_logprob != 0
-        ):
-            score = 1.0
-
-        total_score += score
+    eos_token_id = EOS_TOKEN_ID
+    eot_token_id = EOT_TOKEN_ID
+    res = score_positions(
+        request,
+        prompt_logprobs[len(input_tokens) : len(input_tokens) + idxs],
+        top_logprobs,
+    )
+    if res is None:
+        return None
+    scores, ranks = res
+    failure = hard_failure_message(request, scores, ranks)
+    if failure is not None:
+        return failure
+    total_score = scores.total_score
+    perfect_tokens = scores.perfect_tokens
+    really_low_prob = scores.really_low_prob
+    not_first = scores.not_first
 
     # Check if miner produced non-top ranking tokens more than top-ranking tokens.
     ratio = not_first / len(output_tokens)
@@ -328,10 +500,161 @@ def verify_logprobs(
     return True, "", ""
 
 
+def rank_of(logprob) -> int:
+    if logprob is None:
+        return ABSENT
+    if logprob.rank is None:
+        return UNRANKED
+    return logprob.rank
+
+
+def tokenize_text(input_text: str) -> Tuple[str, List[int]]:
+    if hasattr(TOKENIZER, "bos_token"):
+        if input_text.startswith(TOKENIZER.bos_token):  # type: ignore
+            input_text = input_text[len(TOKENIZER.bos_token) :]  # type: ignore
+    input_tokens = TOKENIZER(input_text).input_ids
+    return str(input_text), input_tokens
+
+
+@lru_cache(maxsize=1024)
+def render_chat(messages_json: str) -> Tuple[str, Tuple[int, ...]]:
+    """
+    The same conversation is verified once per miner queried with it, so
+    renders are cached by the serialized messages.
+    """
+    input_text = TOKENIZER.apply_chat_template(
+        json.loads(messages_json),  # type: ignore
+        tokenize=False,
+        add_special_tokens=False,
+        add_generation_prompt=True,
+    )
+    assert isinstance(input_text, str)
+    input_text, input_tokens = tokenize_text(input_text)
+    return input_text, tuple(input_tokens)
+
+
+def tokenize_input(request: VerificationRequest) -> Tuple[str, List[int]]:
+    if request.request_type == RequestType.COMPLETION.value:
+        assert isinstance(request.request_params.prompt, str)
+        return tokenize_text(request.request_params.prompt)
+    input_text, input_tokens = render_chat(
+        json.dumps(request.request_params.messages, sort_keys=True)
+    )
+    return input_text, list(input_tokens)
+
+
+def build_prompt(
+    input_text: str, input_tokens: List[int], output_sequence: List[OutputItem]
+):
+    """
+    Prompt of the input followed by the miner's output. Uses the miner's token
+    ids directly when it sent all of them, so the output is not re-tokenized
+    and can't drift against `input_tokens`, otherwise falls back to text.
+    """
+    if all(item.token_id >= 0 for item in output_sequence):
+        return {
+            "prompt_token_ids": input_tokens
+            + [item.token_id for item in output_sequence]
+        }
+    return input_text + "".join([item.text for item in output_sequence])
+
+
 @app.post("/verify")
-async def verify(request: VerificationRequest) -> Dict:
+async def verify(request: VerificationRequest):
     """Verify a miner's output."""
+    return await admit(request, lambda timings: verify_output(request, timings))
+
+
+@app.post("/verify/batch")
+async def verify_batch(batch: VerificationBatch):
+    """
+    Verify the outputs of several miners to one request, with the same
+    verdicts as verifying each on its own. Prefills are shared along the
+    token trie of the outputs. Outputs that could not get a slot come back
+    with cause OVERLOADED, to be retried through /verify.
+    """
+    requests = [
+        VerificationRequest(
+            request_type=batch.request_type,
+            model=batch.model,
+            request_params=batch.request_params,
+            output_sequence=output_sequence,
+            priority=batch.priority,
+        )
+        for output_sequence in batch.output_sequences
+    ]
+    checked = [check_shape(request) for request in requests]
+    if all(res is not None for res in checked):
+        return {"results": checked}
+    input_text, input_tokens = await asyncio.to_thread(tokenize_input, requests[0])
+    # Only outputs with all their token ids go in the trie, the rest are
+    # prompted as text and only share identical prompts.
+    sequences = []
+    for request, res in zip(requests, checked):
+        tokens = [item.token_id for item in request.output_sequence]
+        if res is None and all(token_id >= 0 for token_id in tokens):
+            sequences.append(tokens)
+    shared = SharedGenerations(generate, sequences, (EOS_TOKEN_ID, EOT_TOKEN_ID))
+
+    async def verify_one(request: VerificationRequest, res: Optional[Dict]) -> Dict:
+        if res is not None:
+            return res
+        res = await admit(
+            request,
+            lambda timings: verify_tokens(
+                request, input_text, input_tokens, timings, shared
+            ),
+        )
+        if isinstance(res, JSONResponse):
+            return json.loads(bytes(res.body))
+        return res
 
+    results = await asyncio.gather(
+        *[verify_one(request, res) for request, res in zip(requests, checked)]
+    )
+    return {"results": results}
+
+
+async def admit(
+    request: VerificationRequest,
+    run: Callable[[Timings], Awaitable[Dict]],
+):
+    "Runs a verification once the scheduler has a slot for it"
+    priority = request.priority.value
+    timings = Timings(MODEL_NAME, priority, len(request.output_sequence))
+    CURRENT_TIMINGS.set(timings)
+    queued_at = time.perf_counter()
+    try:
+        async with SCHEDULER.slot(priority):
+            QUEUE_WAIT.labels(model=MODEL_NAME, priority=priority).observe(
+                time.perf_counter() - queued_at
+            )
+            result = await run(timings)
+    except Overloaded as e:
+        REJECTIONS.labels(model=MODEL_NAME, priority=priority).inc()
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+            content={"error": str(e), "cause": "OVERLOADED"},
+        )
+    timings.finish(result.get("cause"))
+    return result
+
+
+async def verify_output(request: VerificationRequest, timings: Timings) -> Dict:
+    res = check_shape(request)
+    if res is not None:
+        return res
+
+    # Tokenize the input sequence, off the event loop so other verifications
+    # keep streaming through the engine meanwhile.
+    with timings.stage("tokenize"):
+        input_text, input_tokens = await asyncio.to_thread(tokenize_input, request)
+    return await verify_tokens(request, input_text, input_tokens, timings)
+
+
+def check_shape(request: VerificationRequest) -> Optional[Dict]:
+    "Checks that don't need the model"
     # If the miner didn't return any outputs, fail.
     if len(request.output_sequence) < 3:
         return {
@@ -353,68 +676,262 @@ async def verify(request: VerificationRequest) -> Dict:
             "error": f"Unable to verify model={request.model}, since we are using {MODEL_NAME}",
             "cause": "INTERNAL_ERROR",
         }
+    return None
 
-    # Tokenize the input sequence.
-    input_text = (
-        request.request_params.prompt
-        if request.request_type == RequestType.COMPLETION.value
-        else TOKENIZER.apply_chat_template(
-            request.request_params.messages,  # type: ignore
-            tokenize=False,
-            add_special_tokens=False,
-            add_generation_prompt=True,
+
+async def verify_tokens(
+    request: VerificationRequest,
+    input_text: str,
+    input_tokens: List[int],
+    timings: Timings,
+    shared: Optional[SharedGenerations] = None,
+    scored: Optional[list] = None,
+) -> Dict:
+    # Verify!
+    return_value = {
+        "verified": False,
+        "error": None,
+    }
+
+    # Logprob checks.
+    with timings.stage("logprobs"):
+        res = await verify_logprobs(
+            request, input_text, input_tokens, shared, scored
         )
+    if res is None:
+        return {"error": "Failed to check log probs", "cause": "INTERNAL_ERROR"}
+    result, message, cause = res
+    return_value.update(
+        {
+            "verified": result,
+            "cause": cause,
+            "error": message,
+        }
     )
-    assert isinstance(input_text, str)
-    if hasattr(TOKENIZER, "bos_token"):
-        if input_text.startswith(TOKENIZER.bos_token):  # type: ignore
-            input_text = input_text[len(TOKENIZER.bos_token) :]  # type: ignore
-    input_tokens = TOKENIZER(input_text).input_ids
+    if not result:
+        return return_value
 
-    # Verify!
-    async with LOCK:
-        return_value = {
-            "verified": False,
-            "error": None,
+    # Random logprob check.
+    if request.request_params.temperature > 0.75:
+        return {"verified": True}
+
+    with timings.stage("random_logprobs"):
+        res = await verify_logprobs_random(request, input_text, input_tokens, shared)
+    if res is None:
+        return {
+            "error": "Failed to check log probs",
+            "cause": "INTERNAL_ERROR",
+        }
+    result, message = res
+    return_value.update(
+        {
+            "verified": result,
+            "cause": "LOGPROB_RANDOM",
+            "error": message,
         }
+    )
+    if not result:
+        return return_value
+
+    return {"verified": True}
+
+
+class SessionRequest(BaseModel):
+    request_type: str
+    model: str = MODEL_NAME
+    request_params: RequestParams
+    priority: Priority = Priority.SYNTHETIC
+
+
+class SessionTokens(BaseModel):
+    tokens: List[OutputItem] = []
 
-        # Logprob checks.
-        res = verify_logprobs(request, str(input_text), input_tokens)
-        if res is None:
-            return {"error": "Failed to check log probs", "cause": "INTERNAL_ERROR"}
-        result, message, cause = res
-        return_value.update(
-            {
-                "verified": result,
-                "cause": cause,
-                "error": message,
-            }
+
+class Session:
+    """
+    A miner's output being verified while it is still streaming. Windows of
+    the output so far are scored for the rules that fail at a single token,
+    so an obviously bad stream is flagged early. Each window is twice the
+    last, so together they prefill about twice the output. Windows only run
+    on a free scheduler slot and never queue ahead of verifications.
+
+    The prompt logprobs of the last window are kept, so the final
+    verification only reads the tail off its own pass. That pass still
+    prefills the whole output unless PREFIX_CACHING serves the windowed
+    part from cache.
+    """
+
+    def __init__(self, request: SessionRequest, input_text: str, input_tokens):
+        self.request = request
+        self.input_text = input_text
+        self.input_tokens = input_tokens
+        self.output_sequence: List[OutputItem] = []
+        # Output tokens covered by the last scored window, and the prompt
+        # logprobs at those output positions
+        self.scored = 0
+        self.positions: list = []
+        self.failure: Optional[Tuple[bool, str, str]] = None
+        self.task: Optional[asyncio.Task] = None
+        self.touched = time.monotonic()
+
+    def as_request(self, length: Optional[int] = None) -> VerificationRequest:
+        return VerificationRequest(
+            request_type=self.request.request_type,
+            model=self.request.model,
+            request_params=self.request.request_params,
+            output_sequence=self.output_sequence[:length],
+            priority=self.request.priority,
+        )
+
+    def has_token_ids(self) -> bool:
+        return all(item.token_id >= 0 for item in self.output_sequence)
+
+    def maybe_score(self):
+        if self.failure is not None or (self.task and not self.task.done()):
+            return
+        if len(self.output_sequence) < max(
+            self.scored + SESSION_WINDOW, 2 * self.scored
+        ):
+            return
+        # Windows of text could tokenize differently than the full output
+        if not self.has_token_ids():
+            return
+        # Not needed for the verdict, so never take a slot something waits on
+        if not SCHEDULER.has_free_slot():
+            return
+        self.task = asyncio.create_task(self.score_window(len(self.output_sequence)))
+
+    async def score_window(self, length: int):
+        request = self.as_request(length)
+        top_logprobs, sampling_params = prompt_logprob_sampling(request)
+        try:
+            async with SCHEDULER.slot(request.priority.value):
+                output = await generate(
+                    build_prompt(
+                        self.input_text, self.input_tokens, request.output_sequence
+                    ),
+                    sampling_params,
+                    known=len(self.input_tokens) + len(self.positions),
+                )
+        except Overloaded:
+            # Not needed for the verdict, the final verification covers it
+            return
+        except Exception as e:
+            print("Failed scoring session window", str(e), traceback.format_exc())
+            return
+        self.scored = length
+        if output.prompt_logprobs is None:
+            return
+        positions = output.prompt_logprobs[len(self.input_tokens) :]
+        positions[: len(self.positions)] = self.positions
+        self.positions = positions
+        # The final output is at least this long, so the last 3 positions of
+        # the window may still be past what the full verification scores.
+        self.failure = hard_failure(request, positions[: length - 3], top_logprobs)
+        self.maybe_score()
+
+    def status(self) -> Dict:
+        if self.failure is None:
+            return {"abort": False}
+        _, message, cause = self.failure
+        return {"abort": True, "error": message, "cause": cause}
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+SESSIONS: Dict[str, Session] = {}
+
+
+def expire_sessions():
+    now = time.monotonic()
+    for session_id, session in list(SESSIONS.items()):
+        if now - session.touched > SESSION_TTL:
+            SESSIONS.pop(session_id).close()
+
+
+def get_session(session_id: str) -> Session:
+    session = SESSIONS.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown session")
+    session.touched = time.monotonic()
+    return session
+
+
+@app.post("/sessions")
+async def open_session(req: SessionRequest):
+    """Start verifying an output that is still streaming"""
+    expire_sessions()
+    if req.model != MODEL_NAME:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unable to verify model={req.model}, since we are using {MODEL_NAME}",
         )
-        if not result:
-            return return_value
-
-        # Random logprob check.
-        if request.request_params.temperature > 0.75:
-            return {"verified": True}
-
-        res = verify_logprobs_random(request, str(input_text))
-        if res is None:
-            return {
-                "error": "Failed to check log probs",
-                "cause": "INTERNAL_ERROR",
-            }
-        result, message = res
-        return_value.update(
-            {
-                "verified": result,
-                "cause": "LOGPROB_RANDOM",
-                "error": message,
-            }
+    if len(SESSIONS) >= MAX_SESSIONS:
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": "1"},
+            content={"error": "Too many open sessions", "cause": "OVERLOADED"},
         )
-        if not result:
-            return return_value
+    request = VerificationRequest(
+        request_type=req.request_type,
+        model=req.model,
+        request_params=req.request_params,
+        output_sequence=[],
+    )
+    input_text, input_tokens = await asyncio.to_thread(tokenize_input, request)
+    session = Session(req, input_text, input_tokens)
+    session_id = uuid4().hex
+    SESSIONS[session_id] = session
+    return {"session_id": session_id}
 
-        return {"verified": True}
+
+@app.post("/sessions/{session_id}/tokens")
+async def push_tokens(session_id: str, body: SessionTokens):
+    """Add streamed tokens. Answers whether the stream already failed"""
+    session = get_session(session_id)
+    session.output_sequence += body.tokens
+    session.maybe_score()
+    return session.status()
+
+
+@app.post("/sessions/{session_id}/finish")
+async def finish_session(session_id: str, body: SessionTokens):
+    """
+    Add any last tokens and return the same verdict /verify would. If that
+    answers 429 the session is kept, so finishing can be retried.
+    """
+    session = get_session(session_id)
+    session.output_sequence += body.tokens
+    session.close()
+    request = session.as_request()
+    res = check_shape(request)
+    if res is None and session.failure is not None and session.has_token_ids():
+        verified, message, cause = session.failure
+        res = {"verified": verified, "error": message, "cause": cause}
+    if res is None:
+        res = await admit(
+            request,
+            lambda timings: verify_tokens(
+                request,
+                session.input_text,
+                session.input_tokens,
+                timings,
+                scored=session.positions,
+            ),
+        )
+    if not isinstance(res, JSONResponse):
+        SESSIONS.pop(session_id, None)
+    return res
+
+
+@app.delete("/sessions/{session_id}")
+async def close_session(session_id: str):
+    session = SESSIONS.pop(session_id, None)
+    if session is not None:
+        session.close()
+    return {}
 
 
 @app.get("/endpoints")